@@ -0,0 +1,345 @@
+#!/usr/bin/env python
+"""
+    Benchmarks for boss_worker.py.
+
+    The channel benchmarks fork a writer process that pushes the output of
+    a "chatty" cell through a multiprocessing.Pipe, while this process
+    reads it the way oversee_one_task() does, and time everything from the
+    first byte to the eof.
+    The "legacy" writers use the old protocol (one pickled dict per write()
+    through Connection.send()) so the framed protocol can be compared with
+    it on the same machine.
+
+    The worker benchmarks use real workers, from start_worker(), and
+    chains of middle managers (workers running boss_main(), as in
+    middle_manager_test()) of several depths above the worker that does
+    the task.  For each depth they measure
+        spawn_ms        start_worker() until a task doing nothing is done,
+                        including starting the middle managers' workers,
+        first_byte_ms   sending a task to its first output reaching us,
+        sigint_ms       SIGINT to the worker until the KeyboardInterrupt
+                        traceback reaches us,
+        MB_per_s        output bytes per second, after the first byte,
+        messages_per_s  read_frames() calls per second, likewise.
+
+    Results can be saved as a baseline, and later runs checked against it:
+    a metric more than --tolerance worse than the baseline is reported as a
+    regression, and the exit status is 1.
+
+    Run from the experiments directory:
+        ./bench_boss_worker.py [options] [number_of_writes]
+        ./bench_boss_worker.py --save-baseline baseline.json
+        ./bench_boss_worker.py --baseline baseline.json
+
+    Copyright (c) 2016 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+"""
+
+import sys
+import os
+import time
+import json
+import signal
+import optparse
+import multiprocessing
+from pty import STDOUT_FILENO, STDERR_FILENO
+
+from boss_worker import Frame_writer, Fd_pipe_wrapper, Tty_buffer, \
+    Ring_buffer, read_frames, EOF_FD, start_worker
+
+usage = """\
+usage: %prog [options] [number_of_writes]--benchmark boss_worker.py.
+"""
+optparser = optparse.OptionParser(usage=usage)
+optparser.add_option("--depths", default="0,1,2,3",
+                     help="Middle-manager chain depths for the worker "
+                          "benchmarks (default=%default).")
+optparser.add_option("--lines", type=int, default=5000,
+                     help="Lines of output for MB_per_s (default=%default).")
+optparser.add_option("--repeat", type=int, default=3,
+                     help="Runs of each worker benchmark; the best counts "
+                          "(default=%default).")
+optparser.add_option("--save-baseline", metavar="FILE",
+                     help="Write the results to FILE as JSON.")
+optparser.add_option("--baseline", metavar="FILE",
+                     help="Compare the results with those in FILE.")
+optparser.add_option("--tolerance", type=float, default=0.25,
+                     help="Fraction worse than the baseline that counts as "
+                          "a regression (default=%default).")
+
+
+class Legacy_pipe_wrapper(object):
+    """ Fd_pipe_wrapper before framing: one pickled dict per write(). """
+    def __init__(self, connection, fd):
+        self.conn = connection
+        self.fd = fd
+
+    def write(self, text):
+        self.conn.send({"eof": False, "fd": self.fd, "text": text})
+
+    def flush(self):
+        pass
+
+
+def legacy_writes(conn, ring, n_writes, text):
+    stdout = Legacy_pipe_wrapper(conn, STDOUT_FILENO)
+    for i in xrange(n_writes):
+        stdout.write(text)
+    conn.send({"eof": True})
+
+
+def legacy_lines(conn, ring, n_writes, text):
+    stdout = Tty_buffer(Legacy_pipe_wrapper(conn, STDOUT_FILENO))
+    for i in xrange(n_writes):
+        stdout.write(text)
+    stdout.flush()
+    conn.send({"eof": True})
+
+
+def legacy_read(conn, ring):
+    n_bytes = n_messages = 0
+    while True:
+        chunk = conn.recv()
+        n_messages += 1
+        if chunk["eof"]:
+            return n_bytes, n_messages
+
+        n_bytes += len(chunk["text"])
+
+
+def framed_writes(conn, ring, n_writes, text):
+    """ Raw write()s, as from print i, (trailing comma) without Tty_buffer. """
+    writer = Frame_writer(conn, ring=ring)
+    stdout = Fd_pipe_wrapper(writer, STDOUT_FILENO)
+    for i in xrange(n_writes):
+        stdout.write(text)
+    writer.send_eof()
+
+
+def framed_lines(conn, ring, n_writes, text):
+    """ Writes through Tty_buffer, the way worker_main() sets up stdout. """
+    writer = Frame_writer(conn, ring=ring)
+    stdout = Tty_buffer(Fd_pipe_wrapper(writer, STDOUT_FILENO))
+    for i in xrange(n_writes):
+        stdout.write(text)
+    stdout.flush()
+    writer.send_eof()
+
+
+def framed_read(conn, ring):
+    n_bytes = n_messages = 0
+    while True:
+        n_messages += 1
+        for fd, text in read_frames(conn, ring):
+            if fd == EOF_FD:
+                return n_bytes, n_messages
+
+            n_bytes += len(text)
+
+
+TABLE_ROW = " ".join("%12.6g" % (i * 3.14159) for i in range(80)) + "\n"
+
+BENCHMARKS = [
+    # (name, writer, reader, ring size, text per write)
+    ("legacy words", legacy_writes, legacy_read, 0, "12345 "),
+    ("framed words", framed_writes, framed_read, 0, "12345 "),
+    ("legacy lines", legacy_lines, legacy_read, 0, "line of output 12345\n"),
+    ("framed lines", framed_lines, framed_read, 0, "line of output 12345\n"),
+    ("framed table", framed_lines, framed_read, 0, TABLE_ROW),
+    ("ring table", framed_lines, framed_read, 2**22, TABLE_ROW),
+    ]
+
+
+def run_one(writer, reader, ring_size, n_writes, text):
+    """
+    Return (seconds, bytes, messages) for n_writes writes of text
+    from a writer process to a reader in this process.
+    """
+    ring = ring_size and Ring_buffer(ring_size) or None
+    boss_conn, worker_conn = multiprocessing.Pipe()
+    worker = multiprocessing.Process(target=writer,
+                                     args=(worker_conn, ring, n_writes, text))
+    t0 = time.time()
+    worker.start()
+    n_bytes, n_messages = reader(boss_conn, ring)
+    seconds = time.time() - t0
+    worker.join()
+    return seconds, n_bytes, n_messages
+
+
+def channel_benchmarks(n_writes, results):
+    print "%-14s %10s %12s %10s %12s" \
+        % ("benchmark", "seconds", "MB/s", "messages", "writes/s")
+    for name, writer, reader, ring_size, text in BENCHMARKS:
+        seconds, n_bytes, n_messages = run_one(writer, reader, ring_size,
+                                               n_writes, text)
+        print "%-14s %10.3f %12.2f %10d %12.0f" \
+            % (name, seconds, n_bytes / seconds / 1e6, n_messages,
+               n_writes / seconds)
+        results["channel %s MB_per_s" % name] = n_bytes / seconds / 1e6
+        results["channel %s writes_per_s" % name] = n_writes / seconds
+    ring_speedup = results["channel ring table MB_per_s"] \
+        / results["channel framed table MB_per_s"]
+    print "ring table / framed table: %.2f" % ring_speedup,
+    if ring_speedup < 1.1:
+        print "(no real gain; leave boss_worker.RING_SIZE at 0)"
+    else:
+        print "(consider setting boss_worker.RING_SIZE)"
+
+
+def chain_task(code_string, depth):
+    """
+    Return a task that runs code_string in a worker below depth middle
+    managers.
+    """
+    for level in range(depth, 0, -1):
+        code_string = "from boss_worker import boss_main\n" \
+            "boss_main(%r, '<level %d>')" % (code_string, level)
+    return code_string
+
+
+def time_task(worker, boss_conn, ring, code_string, interrupt=False):
+    """
+    Give the worker a task and read its output to the eof.
+    If interrupt, send the worker SIGINT at the first output.
+    Return a dict with first_byte, the seconds to the first output, and
+    (if interrupt) sigint, the seconds from SIGINT to KeyboardInterrupt,
+    along with seconds, bytes and messages after the first output.
+    """
+    t0 = time.time()
+    boss_conn.send({"do_run": True,
+                    "code_string": code_string,
+                    "code_filename": "<benchmark>",
+                    })
+    timing = {"first_byte": None, "sigint": None, "bytes": 0, "messages": 0}
+    interrupt_time = None
+    while True:
+        frames = read_frames(boss_conn, ring)
+        now = time.time()
+        timing["messages"] += 1
+        for fd, text in frames:
+            if fd == EOF_FD:
+                if timing["first_byte"] != None:
+                    timing["seconds"] = now - t0 - timing["first_byte"]
+                return timing
+
+            if timing["first_byte"] == None:
+                timing["first_byte"] = now - t0
+                timing["messages"] = 0
+            timing["bytes"] += len(text)
+            if interrupt and interrupt_time == None:
+                interrupt_time = time.time()
+                os.kill(worker.pid, signal.SIGINT)
+            elif interrupt_time and timing["sigint"] == None \
+                    and fd == STDERR_FILENO and "KeyboardInterrupt" in text:
+                timing["sigint"] = now - interrupt_time
+
+
+def stop_worker(worker, boss_conn):
+    boss_conn.send({"do_run": False})
+    worker.join()
+
+
+LOOP_FOREVER = """\
+import sys
+print "go"
+sys.stdout.flush()
+while True:
+    pass
+"""
+
+def worker_benchmark(depth, n_lines):
+    """ Return spawn_ms, first_byte_ms, etc. for one chain depth. """
+    t0 = time.time()
+    worker, boss_conn, ring = start_worker()
+    time_task(worker, boss_conn, ring, chain_task("pass", depth))
+    spawn = time.time() - t0
+
+    first_byte = time_task(worker, boss_conn, ring,
+                           chain_task("print 1", depth))["first_byte"]
+    sigint = time_task(worker, boss_conn, ring,
+                       chain_task(LOOP_FOREVER, depth), True)["sigint"]
+    output = time_task(worker, boss_conn, ring, chain_task(
+            "for i in xrange(%d): print %r" % (n_lines, TABLE_ROW[:-1]),
+            depth))
+    stop_worker(worker, boss_conn)
+    return {"spawn_ms": spawn * 1e3,
+            "first_byte_ms": first_byte * 1e3,
+            "sigint_ms": sigint * 1e3,
+            "MB_per_s": output["bytes"] / output["seconds"] / 1e6,
+            "messages_per_s": output["messages"] / output["seconds"],
+            }
+
+
+def worker_benchmarks(depths, n_lines, repeat, results):
+    metrics = ["spawn_ms", "first_byte_ms", "sigint_ms", "MB_per_s",
+               "messages_per_s"]
+    print
+    print "%-8s" % "depth" + "".join("%15s" % metric for metric in metrics)
+    for depth in depths:
+        runs = [worker_benchmark(depth, n_lines) for i in range(repeat)]
+        best = {}
+        for metric in metrics:
+            values = [run[metric] for run in runs]
+            best[metric] = higher_is_better(metric) and max(values) \
+                or min(values)
+            results["depth %d %s" % (depth, metric)] = best[metric]
+        print "%-8d" % depth \
+            + "".join("%15.4g" % best[metric] for metric in metrics)
+
+
+def higher_is_better(metric):
+    return metric.endswith("_per_s")
+
+
+def check_baseline(results, baseline, tolerance):
+    """
+    Print the metrics that are more than tolerance worse than baseline.
+    Return whether there were any.
+    """
+    regressions = []
+    for metric, value in sorted(results.items()):
+        old = baseline.get(metric)
+        if not old:
+            continue
+
+        if higher_is_better(metric):
+            worse = value < old * (1 - tolerance)
+        else:
+            worse = value > old * (1 + tolerance)
+        if worse:
+            regressions.append("%-36s %12.4g -> %-12.4g (%+.0f%%)"
+                               % (metric, old, value,
+                                  (value / old - 1) * 100))
+    print
+    if regressions:
+        print "Regressions against the baseline:"
+        for line in regressions:
+            print "   ", line
+    else:
+        print "No regressions against the baseline."
+    return bool(regressions)
+
+
+def main():
+    args, pargs = optparser.parse_args()
+    n_writes = 200000
+    if pargs:
+        n_writes = int(pargs[0])
+    results = {}
+    channel_benchmarks(n_writes, results)
+    worker_benchmarks([int(depth) for depth in args.depths.split(",")],
+                      args.lines, args.repeat, results)
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+            output.write("\n")
+    if args.baseline:
+        if check_baseline(results, json.load(open(args.baseline)),
+                          args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python
+"""
+    HTTP load test of the PyInThePhone server.
+
+    Starts scripts/pyinthephone.py on a loopback port, drives it with
+    concurrent client processes, and reports, for each kind of request and
+    overall, the throughput and the 50th, 95th and 99th percentile latency,
+    plus the server's peak RSS.  Results can be written as JSON, and two
+    JSON results compared.  Nothing here needs a network or any package
+    outside the standard library.
+
+    Run from the pyinthephone directory, e.g.:
+        experiments/bench_http.py --clients 4 --seconds 10 --json before.json
+        experiments/bench_http.py --clients 4 --seconds 10 --json after.json \
+            --server-option=--threads
+        experiments/bench_http.py --compare before.json after.json
+
+    Every python-post request adds a cell to the notebook, so python-get
+    pages grow during a run; compare runs of the same length.
+
+    Copyright (c) 2016 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+"""
+
+import sys
+import os
+import time
+import json
+import socket
+import httplib
+import urllib
+import optparse
+import subprocess
+import multiprocessing
+
+usage = """\
+usage: %prog [options]--load-test the PyInThePhone server.
+       %prog --compare OLD.json NEW.json
+"""
+optparser = optparse.OptionParser(usage=usage)
+optparser.add_option("--port", type=int, default=8765,
+                     help="Loopback port to serve on (default=%default).")
+optparser.add_option("--clients", type=int, default=4,
+                     help="Concurrent client processes (default=%default).")
+optparser.add_option("--seconds", type=float, default=5.0,
+                     help="How long to run (default=%default).")
+optparser.add_option("--requests", default=",".join(sorted(["home",
+                         "static", "download", "environ", "python-get",
+                         "python-post"])),
+                     help="Comma-separated kinds of request to make, in "
+                          "turn (default=%default).")
+optparser.add_option("--server-option", action="append", default=[],
+                     metavar="OPTION",
+                     help="Pass OPTION on to pyinthephone.py, e.g. "
+                          "--server-option=--threads.  Can be repeated.")
+optparser.add_option("--json", metavar="FILE",
+                     help="Write the results to FILE as JSON.")
+optparser.add_option("--compare", action="store_true", default=False,
+                     help="Compare two JSON results instead of running.")
+
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+SERVED_FILE = "scripts/makeargv.py"
+
+# Kind of request => (method, path, POST body or None).
+REQUESTS = {
+    "home": ("GET", "/", None),
+    "static": ("GET", "/static/" + SERVED_FILE, None),
+    "download": ("GET", "/download/" + SERVED_FILE, None),
+    "environ": ("GET", "/environ", None),
+    "python-get": ("GET", "/python", None),
+    "python-post": ("POST", "/python",
+                    urllib.urlencode({"input_text": "x = sum(range(100))"})),
+    }
+
+
+def start_server(port, server_options):
+    """ Start pyinthephone.py and wait till it takes connections. """
+    server = subprocess.Popen(
+        [sys.executable, "scripts/pyinthephone.py", "--python",
+         "--port", str(port)] + server_options + [SERVED_FILE],
+        cwd=ROOT, stdout=open(os.devnull, "w"), stderr=subprocess.STDOUT)
+    deadline = time.time() + 10
+    while True:
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return server
+        except socket.error:
+            if server.poll() != None or time.time() > deadline:
+                raise RuntimeError("The server didn't start.")
+
+            time.sleep(0.05)
+
+
+def peak_rss_bytes(pid):
+    """ Peak resident set size of process pid, or None if unknown. """
+    try:
+        for line in open("/proc/%d/status" % pid):
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def client(args):
+    """
+    In a client process: make requests of the given kinds in turn until
+    stop_time.  Return a list of (kind, seconds, ok) per request.
+    """
+    port, kinds, stop_time = args
+    results = []
+    i = 0
+    while time.time() < stop_time:
+        kind = kinds[i % len(kinds)]
+        method, path, body = REQUESTS[kind]
+        headers = {}
+        if body:
+            headers["Content-Type"] = "application/x-www-form-urlencoded"
+        t0 = time.time()
+        try:
+            connection = httplib.HTTPConnection("127.0.0.1", port, timeout=30)
+            connection.request(method, path, body, headers)
+            response = connection.getresponse()
+            response.read()
+            ok = response.status == 200
+            connection.close()
+        except (socket.error, httplib.HTTPException):
+            ok = False
+        results.append( (kind, time.time() - t0, ok) )
+        i += 1
+    return results
+
+
+def percentile_ms(sorted_seconds, fraction):
+    if not sorted_seconds:
+        return None
+
+    i = min(len(sorted_seconds) - 1, int(fraction * len(sorted_seconds)))
+    return sorted_seconds[i] * 1e3
+
+
+def summarize(results, seconds):
+    """ Return a dict of throughput and latency stats for results. """
+    latencies = sorted(latency for kind, latency, ok in results)
+    return {
+        "requests": len(results),
+        "errors": len([ok for kind, latency, ok in results if not ok]),
+        "requests_per_second": len(results) / seconds,
+        "p50_ms": percentile_ms(latencies, 0.50),
+        "p95_ms": percentile_ms(latencies, 0.95),
+        "p99_ms": percentile_ms(latencies, 0.99),
+        }
+
+
+def run(args):
+    kinds = args.requests.split(",")
+    for kind in kinds:
+        if kind not in REQUESTS:
+            optparser.error("No such kind of request: %r" % kind)
+
+    server = start_server(args.port, args.server_option)
+    try:
+        pool = multiprocessing.Pool(args.clients)
+        start = time.time()
+        stop_time = start + args.seconds
+        # Start each client on a different kind of request.
+        per_client = pool.map(client, [
+                (args.port, kinds[i % len(kinds):] + kinds[:i % len(kinds)],
+                 stop_time)
+                for i in range(args.clients)])
+        seconds = time.time() - start
+        pool.close()
+        server_peak_rss = peak_rss_bytes(server.pid)
+    finally:
+        server.kill()
+        server.wait()
+
+    results = [result for results in per_client for result in results]
+    by_kind = {}
+    for kind in kinds:
+        by_kind[kind] = summarize([result for result in results
+                                   if result[0] == kind], seconds)
+    return {
+        "settings": {"clients": args.clients, "seconds": args.seconds,
+                     "requests": kinds, "server_options": args.server_option,
+                     "python": sys.version.split()[0]},
+        "overall": summarize(results, seconds),
+        "by_request": by_kind,
+        "server_peak_rss_bytes": server_peak_rss,
+        }
+
+
+ROW = "%-12s %9s %9s %10s %9s %9s %9s"
+
+def print_results(results):
+    print ROW % ("request", "count", "errors", "req/s",
+                 "p50 ms", "p95 ms", "p99 ms")
+    rows = sorted(results["by_request"].items()) \
+        + [("overall", results["overall"])]
+    for kind, stats in rows:
+        print ROW % (kind, stats["requests"], stats["errors"],
+                     format_number(stats["requests_per_second"]),
+                     format_number(stats["p50_ms"]),
+                     format_number(stats["p95_ms"]),
+                     format_number(stats["p99_ms"]))
+    if results["server_peak_rss_bytes"]:
+        print "server peak RSS: %.1f MB" \
+            % (results["server_peak_rss_bytes"] / 1e6)
+
+
+def format_number(value):
+    if value == None:
+        return "-"
+    return "%.4g" % value
+
+
+def compare(old_filename, new_filename):
+    """ Print new/old ratios of two runs' throughput and latencies. """
+    old = json.load(open(old_filename))
+    new = json.load(open(new_filename))
+    print "new / old"
+    print ROW % ("request", "count", "errors", "req/s",
+                 "p50 ms", "p95 ms", "p99 ms")
+    old_rows = dict(old["by_request"], overall=old["overall"])
+    new_rows = dict(new["by_request"], overall=new["overall"])
+    for kind in sorted(set(old_rows) & set(new_rows)):
+        ratios = []
+        for key in ["requests_per_second", "p50_ms", "p95_ms", "p99_ms"]:
+            if old_rows[kind][key] and new_rows[kind][key] != None:
+                ratios.append("%.3f" % (new_rows[kind][key]
+                                        / old_rows[kind][key]))
+            else:
+                ratios.append("-")
+        print ROW % tuple([kind, "%d/%d" % (new_rows[kind]["requests"],
+                                            old_rows[kind]["requests"]),
+                           "%d/%d" % (new_rows[kind]["errors"],
+                                      old_rows[kind]["errors"])]
+                          + ratios)
+    if old["server_peak_rss_bytes"] and new["server_peak_rss_bytes"]:
+        print "server peak RSS: %.3f" % (float(new["server_peak_rss_bytes"])
+                                         / old["server_peak_rss_bytes"])
+
+
+def main():
+    args, filenames = optparser.parse_args()
+    if args.compare:
+        if len(filenames) != 2:
+            optparser.error("--compare takes two JSON files.")
+        compare(*filenames)
+        return
+
+    results = run(args)
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as output:
+            json.dump(results, output, indent=1, sort_keys=True)
+            output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
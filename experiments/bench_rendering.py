@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+"""
+    Microbenchmarks of the PyInThePhone server's routing and rendering.
+
+    Calls match_route(), fill_template() (and so HTML_dict_wrapper),
+    simple_wrap(), unixify_newlines(), render_notebook_frozen() and
+    do_python() directly, in this process, with no sockets; do_python()
+    renders notebooks of 10, 1000 and 10000 cells.
+
+    Each benchmark has a threshold in THRESHOLDS, in microseconds per call.
+    Any benchmark slower than its threshold (times --scale, for slower
+    machines such as phones) is reported as a FAILURE and the exit status
+    is 1.
+
+    Run from the pyinthephone directory:
+        experiments/bench_rendering.py [--scale 5]
+
+    Copyright (c) 2016 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+"""
+
+import sys
+import os
+import time
+import StringIO
+import optparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "scripts"))
+import pyinthephone
+from pyinthephone import match_route, fill_template, simple_wrap, \
+    unixify_newlines, render_notebook_frozen, NOTEBOOK_FROZEN, NOTEBOOK_WIDTH
+
+usage = """\
+usage: %prog [options]--microbenchmark routing and rendering.
+"""
+optparser = optparse.OptionParser(usage=usage)
+optparser.add_option("--scale", type=float, default=1.0,
+                     help="Multiply every threshold by this "
+                          "(default=%default).")
+optparser.add_option("--seconds", type=float, default=0.2,
+                     help="Least time to spend per benchmark run "
+                          "(default=%default).")
+
+
+# Benchmark name => most microseconds per call allowed.  These are about
+# five times what a laptop takes, to leave room for noise.
+THRESHOLDS = {
+    "match_route exact": 2.5,
+    "match_route wildcard": 10.0,
+    "match_route miss": 12.0,
+    "fill_template": 15.0,
+    "simple_wrap short": 6.0,
+    "simple_wrap long": 150.0,
+    "unixify_newlines": 4.0,
+    "render_notebook_frozen": 120.0,
+    "do_python 10 cells": 1300.0,
+    "do_python 1000 cells": 150000.0,
+    "do_python 10000 cells": 1100000.0,
+    }
+
+CELL_INPUT = """\
+for i in range(10):
+    print i, i * i
+"""
+CELL_OUTPUT = "".join("%d %d\n" % (i, i * i) for i in range(10))
+CELL_METRICS = {"wall_seconds": 0.001, "cpu_seconds": 0.001,
+                "peak_rss_kb": 0, "output_bytes": len(CELL_OUTPUT),
+                "ran": "here"}
+LONG_TEXT = ("x" * 200 + "\n") * 50
+CRLF_TEXT = "print 'hello'\r\nprint 'world'\r\n" * 5
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def python_page(n_cells):
+    """ Return a function that renders a notebook of n_cells cells. """
+    notebook = [(CELL_INPUT, CELL_OUTPUT, "", CELL_METRICS)] * n_cells
+    environ = {"PATH_INFO": "/python", "REQUEST_METHOD": "GET",
+               "QUERY_STRING": "", "wsgi.input": StringIO.StringIO(""),
+               "CONTENT_LENGTH": "", "PATH_INFO_MATCHED": "/python",
+               "PATH_INFO_TAIL": ""}
+    def render():
+        pyinthephone.NOTEBOOK_ABOVE = notebook
+        pyinthephone.do_python(environ, start_response)
+    return render
+
+
+BENCHMARKS = [
+    ("match_route exact", lambda: match_route("/python")),
+    ("match_route wildcard",
+     lambda: match_route("/static/scripts/pyinthephone.py")),
+    ("match_route miss", lambda: match_route("/no/such/page/here")),
+    ("fill_template", lambda: fill_template(NOTEBOOK_FROZEN,
+         {"color": "white", "text": CELL_OUTPUT + "<&>\""})),
+    ("simple_wrap short", lambda: simple_wrap(CELL_INPUT, NOTEBOOK_WIDTH,
+                                              True)),
+    ("simple_wrap long", lambda: simple_wrap(LONG_TEXT, NOTEBOOK_WIDTH)),
+    ("unixify_newlines", lambda: unixify_newlines(CRLF_TEXT)),
+    ("render_notebook_frozen", lambda: render_notebook_frozen(
+         (CELL_INPUT, CELL_OUTPUT, "", CELL_METRICS), NOTEBOOK_WIDTH,
+         "/python?edit=0#anchor")),
+    ("do_python 10 cells", python_page(10)),
+    ("do_python 1000 cells", python_page(1000)),
+    ("do_python 10000 cells", python_page(10000)),
+    ]
+
+
+def time_calls(function, min_seconds):
+    """
+    Call function 1, 10, 100... times in a row until that takes at least
+    min_seconds, three times over.  Return the best microseconds per call.
+    """
+    number = 1
+    while True:
+        seconds = run_calls(function, number)
+        if seconds >= min_seconds:
+            break
+
+        number *= 10
+    best = min([seconds] + [run_calls(function, number) for i in range(2)])
+    return best / number * 1e6
+
+
+def run_calls(function, number):
+    t0 = time.time()
+    for i in xrange(number):
+        function()
+    return time.time() - t0
+
+
+def main():
+    args, pargs = optparser.parse_args()
+    pyinthephone.DO_PYTHON = True
+    failures = []
+    print "%-24s %14s %14s" % ("benchmark", "usec/call", "threshold")
+    for name, function in BENCHMARKS:
+        usec = time_calls(function, args.seconds)
+        threshold = THRESHOLDS[name] * args.scale
+        if usec > threshold:
+            failures.append(name)
+            verdict = "  FAILURE"
+        else:
+            verdict = ""
+        print "%-24s %14.2f %14.2f%s" % (name, usec, threshold, verdict)
+    if failures:
+        print >>sys.stderr, "\nSLOWER THAN THRESHOLD: %s" % ", ".join(failures)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
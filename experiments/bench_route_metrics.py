@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+    Benchmark of the per-route request metrics in pyinthephone.py.
+
+    Times do_route() on a route whose handler does nothing, against a copy
+    of do_route() without the metrics, and prints the difference per
+    request.  It should stay under a few microseconds.
+
+    Run from the pyinthephone directory:
+        experiments/bench_route_metrics.py [number_of_requests]
+
+    Copyright (c) 2016 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+"""
+
+import sys
+import os
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "scripts"))
+import pyinthephone
+from pyinthephone import route, match_route, do_404
+
+
+@route("/bench/")
+@route("/bench/*")
+def do_nothing(environ, start_response):
+    start_response("200 OK", [])
+    return ["ok"]
+
+
+def unrecorded_do_route(environ, start_response):
+    """ do_route() as it was before ROUTE_STATS. """
+    handler, matched, tail = match_route(environ["PATH_INFO"])
+    if not handler:
+        return do_404(environ, start_response)
+
+    handler_environ = dict(environ)
+    handler_environ["PATH_INFO_MATCHED"] = matched
+    handler_environ["PATH_INFO_TAIL"] = tail
+    return handler(handler_environ, start_response)
+
+
+def start_response(status, headers, exc_info=None):
+    pass
+
+
+def time_routing(do_route, path, n_requests):
+    """ Return seconds per request for do_route() on path. """
+    environ = {"PATH_INFO": path, "REQUEST_METHOD": "GET",
+               "QUERY_STRING": ""}
+    t0 = time.time()
+    for i in xrange(n_requests):
+        do_route(environ, start_response)
+    return (time.time() - t0) / n_requests
+
+
+def main(n_requests=200000):
+    print "%-20s %12s %12s %12s" \
+        % ("path", "plain usec", "metrics usec", "overhead")
+    for path in ["/bench", "/bench/some/file.txt", "/no/such/page"]:
+        # Best of three, to keep other activity on the box out of it.
+        plain = min(time_routing(unrecorded_do_route, path, n_requests)
+                    for i in range(3))
+        recorded = min(time_routing(pyinthephone.do_route, path, n_requests)
+                       for i in range(3))
+        print "%-20s %12.2f %12.2f %12.2f" \
+            % (path, plain * 1e6, recorded * 1e6, (recorded - plain) * 1e6)
+
+
+if __name__ == "__main__":
+    main(*[int(arg) for arg in sys.argv[1:]])
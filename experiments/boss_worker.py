@@ -13,7 +13,8 @@
     Output can show up in dribs and drabs with pauses between.
     Stdout and stderr streams are multiplexed through a pipe and
     come out the terminal's stdout and stderr respectively.
-    Outputs are buffered, with flushing both at newlines and
+    Outputs are buffered, with flushing both at newlines (lines that come
+    thick and fast are bundled, up to 30 ms at a time) and
     when the interpreted code calls flush() "manually".
 
     ^C from the keyboard is caught and relayed to the worker
@@ -44,10 +45,20 @@ import ast
 import traceback
 import multiprocessing
 import time
+import math
 import signal
 import errno
+import resource
+import struct
+import mmap
+import threading
+import mimetypes
 from pty import STDIN_FILENO, STDOUT_FILENO, STDERR_FILENO
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "scripts"))
+import blob_store
+
 
 def stdin_readlines(task_filename):
     """
@@ -82,54 +93,279 @@ def stdin_readlines(task_filename):
     return lines
 
 
+# Worker-to-boss output travels as frames packed into byte strings and sent
+# with Connection.send_bytes(), rather than as one pickled dict per write().
+# Each frame is a FRAME_HEADER (fd byte, payload length) followed by the
+# payload.  A frame whose fd is EOF_FD means the task's output is finished.
+FRAME_HEADER = struct.Struct("!BI")
+EOF_FD = 255
+DOORBELL_FD = 254  # See Ring_buffer.
+PID_FD = 253       # The worker's pid, as text, when a new process takes over.
+DISPLAY_FD = 252   # A rich output: mime type, "\0", then the data.
+
+# Size in bytes of the shared-memory Ring_buffer boss_main() gives each
+# worker for its output.  0 means output goes through the pipe alone.
+# The ring stays off unless bench_boss_worker.py shows it's faster on the
+# device at hand: where it's been measured, per-write work in Python, not
+# the pipe, limits throughput, and "ring table" is no faster (sometimes
+# slower) than "framed table".
+RING_SIZE = 0
+
+RING_HEADER = struct.Struct("II")
+RING_POSITION = struct.Struct("I")
+
+
+class Ring_buffer(object):
+    """
+    A single-producer/single-consumer ring of bytes in shared memory,
+    for worker output that would otherwise be copied through the pipe.
+    Create it before the worker process is forked; the anonymous mmap
+    is then shared by both processes.
+
+    The map starts with RING_HEADER: the producer's write position, then
+    the consumer's read position.  Positions count bytes ever written
+    (mod 2**32) and each side only ever stores its own; 4-byte aligned
+    stores are atomic even on 32-bit ARM.  The capacity must be a power
+    of two so that positions wrap around in step with the ring.
+
+    The ring carries no notifications of its own.  Frame_writer rings a
+    "doorbell" on the pipe after each put(): a DOORBELL_FD frame holding
+    the new write position.  read_frames() then takes frames just up to
+    that position, so ring data and frames sent directly through the pipe
+    come out in the order they were written.
+    Each byte is copied once going in and once coming out.
+    """
+    def __init__(self, capacity):
+        assert 0 < capacity < 2**31 and capacity & (capacity - 1) == 0
+        self.capacity = capacity
+        self.map = mmap.mmap(-1, RING_HEADER.size + capacity)
+
+    def __repr__(self):
+        return "Ring_buffer(%d)" % self.capacity
+
+    def put(self, pieces, length):
+        """
+        Producer side.  Copy in the strings in pieces, length bytes in all,
+        and return the new write position, or None if there isn't room.
+        """
+        head, tail = RING_HEADER.unpack_from(self.map, 0)
+        if length > self.capacity - ((head - tail) & 0xFFFFFFFF):
+            return None
+
+        offset = head % self.capacity
+        for piece in pieces:
+            start = RING_HEADER.size + offset
+            first = min(len(piece), self.capacity - offset)
+            self.map[start:start + first] = piece[:first]
+            if first < len(piece):
+                rest = len(piece) - first
+                self.map[RING_HEADER.size:RING_HEADER.size + rest] \
+                    = piece[first:]
+            offset = (offset + len(piece)) % self.capacity
+        head = (head + length) & 0xFFFFFFFF
+        RING_POSITION.pack_into(self.map, 0, head)
+        return head
+
+    def write_position(self):
+        return RING_POSITION.unpack_from(self.map, 0)[0]
+
+    def read(self, position, length):
+        """ Return length bytes starting at position. """
+        offset = position % self.capacity
+        start = RING_HEADER.size + offset
+        first = min(length, self.capacity - offset)
+        data = self.map[start:start + first]
+        if first < length:
+            data += self.map[RING_HEADER.size:
+                             RING_HEADER.size + length - first]
+        return data
+
+    def get_frames(self, upto, frames):
+        """
+        Consumer side.  Append the frames from the read position up to
+        write position upto (from a doorbell) to frames, as (fd, text)
+        pairs, and free their space.
+        """
+        pos = RING_POSITION.unpack_from(self.map, RING_POSITION.size)[0]
+        while pos != upto:
+            fd, length = FRAME_HEADER.unpack(self.read(pos, FRAME_HEADER.size))
+            pos = (pos + FRAME_HEADER.size) & 0xFFFFFFFF
+            frames.append( (fd, self.read(pos, length)) )
+            pos = (pos + length) & 0xFFFFFFFF
+        RING_POSITION.pack_into(self.map, RING_POSITION.size, upto)
+
+
+class Frame_writer(object):
+    """
+    The sending end of the framed worker-to-boss output protocol.
+    Writes to any number of fds are packed into frames, in order, and
+    coalesced into one message until max_bytes are waiting or max_delay
+    seconds have passed since the first waiting write; then the whole
+    batch goes out in one send_bytes() call.  Consecutive writes to the
+    same fd share a single frame.
+    To keep write() cheap, the clock is only looked at once per check_bytes
+    of output, so the delay is a bound for steady output, not a timer.
+    flush() sends whatever is waiting right away.
+    send_eof() flushes and tells the other end the task is finished.
+
+    Texts must be str, not unicode (see Fd_pipe_wrapper.write()).
+
+    If a Ring_buffer is given, batches are copied into it and only a
+    doorbell frame goes through the pipe; a batch that doesn't fit goes
+    through the pipe as usual.
+
+    The other end calls read_frames() on its end of the pipe,
+    with the same ring.
+    """
+    def __init__(self, connection, max_bytes=65536, max_delay=0.03,
+                 check_bytes=1024, ring=None):
+        self.conn = connection
+        self.ring = ring
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.check_bytes = check_bytes
+        self.frames = []      # Finished frames, each header + payload.
+        self.run_fd = None    # fd of the frame still being added to...
+        self.run = []         # ...and its payload pieces.
+        self.size = 0         # Payload bytes waiting...
+        self.frame_bytes = 0  # ...plus this many bytes of headers.
+        self.run_start = 0    # self.size when the run began.
+        self.check_at = check_bytes
+        self.first_time = None
+
+    def __repr__(self):
+        return "Frame_writer(%r, max_bytes=%d, max_delay=%r)" \
+            % (self.conn, self.max_bytes, self.max_delay)
+
+    def write(self, fd, text):
+        if fd != self.run_fd:
+            self.end_run()
+            if self.first_time == None:
+                self.first_time = time.time()
+            self.run_fd = fd
+            self.run_start = self.size
+        self.run.append(text)
+        self.size += len(text)
+        if self.size >= self.check_at:
+            if self.size >= self.max_bytes \
+                    or time.time() - self.first_time >= self.max_delay:
+                self.flush()
+            else:
+                self.check_at = min(self.size + self.check_bytes,
+                                    self.max_bytes)
+
+    def end_run(self):
+        """ Close off the frame being added to, if any. """
+        if self.run:
+            self.frames.append(FRAME_HEADER.pack(self.run_fd,
+                                                 self.size - self.run_start))
+            self.frames += self.run
+            self.frame_bytes += FRAME_HEADER.size
+        self.run_fd = None
+        self.run = []
+
+    def flush(self):
+        self.end_run()
+        if self.frames:
+            pieces = self.frames
+            if self.ring == None or len(pieces) > 64:
+                # Many small pieces are quicker to copy all at once.
+                pieces = ["".join(pieces)]
+            head = None
+            if self.ring != None:
+                head = self.ring.put(pieces, self.size + self.frame_bytes)
+            if head != None:
+                self.conn.send_bytes(DOORBELL + RING_POSITION.pack(head))
+            elif self.ring != None:
+                # No room; send it the slow way, after what's in the ring.
+                head = self.ring.write_position()
+                self.conn.send_bytes(DOORBELL + RING_POSITION.pack(head)
+                                     + "".join(pieces))
+            else:
+                self.conn.send_bytes(pieces[0])
+            self.frames = []
+        self.size = 0
+        self.frame_bytes = 0
+        self.check_at = self.check_bytes
+        self.first_time = None
+
+    def send_eof(self):
+        self.end_run()
+        self.frames.append(FRAME_HEADER.pack(EOF_FD, 0))
+        self.frame_bytes += FRAME_HEADER.size
+        self.flush()
+
+
+DOORBELL = FRAME_HEADER.pack(DOORBELL_FD, RING_POSITION.size)
+
+
+def read_frames(connection, ring=None):
+    """
+    Receive one message sent by a Frame_writer, and
+    return its contents as a list of (fd, text) pairs.
+    Doorbell frames are replaced by the frames they point to in ring.
+    """
+    message = connection.recv_bytes()
+    frames = []
+    pos = 0
+    while pos < len(message):
+        fd, length = FRAME_HEADER.unpack_from(message, pos)
+        pos += FRAME_HEADER.size
+        if fd == DOORBELL_FD:
+            ring.get_frames(RING_POSITION.unpack_from(message, pos)[0],
+                            frames)
+        else:
+            frames.append( (fd, message[pos:pos + length]) )
+        pos += length
+    return frames
+
+
 class Fd_pipe_wrapper():
     """
-    Wrapper to redirect an output stream into a multiprocessing.Connection
-    pipe-end, in such a way that it can be multiplexed with other output
-    streams.
+    Wrapper to redirect an output stream into a Frame_writer (and so into
+    a multiprocessing.Connection pipe-end), in such a way that it can be
+    multiplexed with other output streams.
     As in:
-        stdout = Fd_pipe_wrapper(conn, STDOUT_FILENO)
-        stderr = Fd_pipe_wrapper(conn, STDERR_FILENO)
+        writer = Frame_writer(conn)
+        stdout = Fd_pipe_wrapper(writer, STDOUT_FILENO)
+        stderr = Fd_pipe_wrapper(writer, STDERR_FILENO)
         print >>stdout, "Output to stdout."
         print >>stderr, "Message to stderr."
-        conn.send({"eof": True})
-        
-    Uses a convention of sending dictionaries like this through the pipe:
-        {"eof": False, "fd": 0, "str": "Output to stdout.\n"}
-    Each call to a wrapper's write() method produces one of these; in general
-    each is just a chunk of text, not necessarily a whole or single line.
+        writer.send_eof()
+
+    Each call to a wrapper's write() method adds its text to a frame
+    tagged with the wrapper's fd; in general each is just a chunk of text,
+    not necessarily a whole or single line.
     Deciding whether and where to put newlines is up to the caller, although
     print statements (as above) insert them automatically.
     Decoding where lines end is up to the code at the other end of the pipe.
-    
+
     To signal that the fds have closed (all together), code outside this
-    class should do this:
-        conn.send({"eof": True})
-    This is not sent by the wrappers' close() method, on the theory that
+    class should call the Frame_writer's send_eof() method.
+    This is not done by the wrappers' close() method, on the theory that
     there are multple streams to close, but only one eof message should
     be sent to close them all together.
-    
-    There is no code in this class to interpret the sent dictionaries at the
-    other end of the pipe.
-    
+
     Thanks to ibell at http://stackoverflow.com/questions/11129414
     """
-    def __init__(self, connection, fd):
-        self.conn = connection
+    def __init__(self, writer, fd):
+        self.writer = writer
         self.fd = fd
 
     def __repr__(self):
-        return "Fd_pipe_wrapper(%r, %d)" % (self.conn, self.fd)
+        return "Fd_pipe_wrapper(%r, %d)" % (self.writer, self.fd)
         
     def write(self, text):
-        self.conn.send({"eof": False, "fd": self.fd, "text": text})
+        if isinstance(text, unicode):
+            text = text.encode("utf-8")
+        self.writer.write(self.fd, text)
         
     def flush(self):
         """
-        This class does no buffering of its own,
-        but see the Tty_buffer class.
+        Send everything the Frame_writer is holding, for any fd.
+        See also the Tty_buffer class.
         """
-        pass
+        self.writer.flush()
     
     def close(self):
         """ See Fd_pipe_wrapper top docstring about how to signal EOF. """
@@ -140,45 +376,134 @@ class Tty_buffer(object):
     """
     An object that wraps a file-like object
     and does buffering for it the way the stdout does
-    when connected to a terminal, i.e., flush on newlines.
+    when connected to a terminal, i.e., flush on newlines--
+    but at most once per max_latency seconds.
+
+    Written strings are kept in a list, so appending is O(1), and are
+    joined only when flushed.  Complete lines are passed on to the file
+        o  at once, if the last flush was at least max_latency seconds ago
+           (so the first line after a pause shows up without delay),
+        o  otherwise by a flusher thread, max_latency seconds later,
+           bundled with any lines written in the meantime.
+    buffsize bytes waiting force a flush of everything, even a partial line.
+    max_latency=None flushes at every newline, as a terminal does.
+
+    Buffers that share a file (e.g. stdout and stderr sharing one
+    Frame_writer) should share a lock, since the flusher threads call
+    the file's methods.  If flush_first is another such buffer, its
+    complete lines are flushed before anything from this one, so that,
+    e.g., stderr messages don't overtake earlier lines of stdout.
     """
-    def __init__(self, file_like_object, buffsize=2048):
+    def __init__(self, file_like_object, buffsize=65536, max_latency=0.03,
+                 lock=None, flush_first=None):
         self.file = file_like_object
+        self.flush_first = flush_first
         self.buffsize = buffsize
-        self.buffer = ""
+        self.max_latency = max_latency
+        self.lock = lock or threading.Lock()
+        self.pieces = []
+        self.size = 0
+        self.line_end = 0      # Bytes up to and including the last newline.
+        self.flush_time = 0.0
+        self.armed = False     # Whether the flusher thread is due...
+        self.due = None        # ...woken by this Event...
+        self.flusher_pid = None  # ...and belongs to this process.  (A
+                                 # forked copy can inherit armed=True
+                                 # without the thread, so check.)
 
     def __repr__(self):
-        return "Tty_buffer(%r, buffsize=%d)" % (self.file, self.buffsize)
+        return "Tty_buffer(%r, buffsize=%d, max_latency=%r)" \
+            % (self.file, self.buffsize, self.max_latency)
 
     def write(self, string):
-        self.buffer += string
-        if len(self.buffer) >= self.buffsize:
-            self.flush()
-        else:
-            p = string.rfind('\n')
-            if p > -1:
-                # Flush up to the (last) newline.
-                p = p - len(string) + len(self.buffer)
-                self.file.write(self.buffer[:p + 1])
-                self.file.flush()
-                self.buffer = self.buffer[p + 1:]
+        if isinstance(string, unicode):
+            string = string.encode("utf-8")
+        with self.lock:
+            self.pieces.append(string)
+            self.size += len(string)
+            if self.size >= self.buffsize:
+                self.flush_unlocked()
+            else:
+                p = string.rfind('\n')
+                if p > -1:
+                    self.line_end = self.size - len(string) + p + 1
+                    if self.armed and self.flusher_pid == os.getpid():
+                        pass
+                    elif not self.max_latency \
+                            or time.time() - self.flush_time \
+                               >= self.max_latency:
+                        self.flush_lines()
+                    else:
+                        self.arm_flusher()
 
-    def flush(self):
-        if self.buffer:
-            self.file.write(self.buffer)
-            self.buffer = ""
+    def flush_lines(self):
+        """ Flush up to the last newline.  Call with self.lock held. """
+        if self.line_end:
+            if self.flush_first:
+                self.flush_first.flush_lines()
+            data = "".join(self.pieces)
+            self.pieces = [data[self.line_end:]]
+            self.size -= self.line_end
+            self.file.write(data[:self.line_end])
+            self.file.flush()
+            self.line_end = 0
+            self.flush_time = time.time()
+
+    def arm_flusher(self):
+        """
+        Make sure a flusher thread is waiting in this process,
+        and tell it there are lines to flush.
+        """
+        if self.flusher_pid != os.getpid():
+            # First time, or this is a forked copy without the thread.
+            self.due = threading.Event()
+            flusher = threading.Thread(target=self.flusher)
+            flusher.daemon = True
+            flusher.start()
+            self.flusher_pid = os.getpid()
+        self.armed = True
+        self.due.set()
+
+    def flusher(self):
+        while True:
+            self.due.wait()
+            time.sleep(self.max_latency)
+            with self.lock:
+                self.armed = False
+                self.due.clear()
+                self.flush_lines()
+
+    def flush_unlocked(self):
+        if self.size:
+            if self.flush_first:
+                self.flush_first.flush_lines()
+            self.file.write("".join(self.pieces))
+            self.pieces = []
+            self.size = 0
+            self.line_end = 0
         self.file.flush()
+        self.flush_time = time.time()
+
+    def flush(self):
+        with self.lock:
+            self.flush_unlocked()
 
     def close(self):
         self.flush()
     
 
-def worker_main(worker_conn):
+def worker_main(worker_conn, ring=None):
     """
     Within the worker process, this is the "target" function that is run.
     It's the Python read-eval-print loop within the worker.
     It has a globals dictionary that persists between code_string tasks.
     worker_conn is the worker's end of the boss <-> worker pipe.
+    Each task is a dict with "do_run", "code_string", "code_filename",
+    and optionally "limits" (see arm_limits()) and "checkpoint" (True to
+    fork_checkpoint() before running the task).
+    A task {"do_run": True, "revert_to": code_filename} makes the
+    checkpoint from before that task take over as the worker.
+    ring, if not None, is a Ring_buffer shared with the boss for output.
 
     code_cache stores all the code_strings that have been seen, to allow
     error/exception/control-C tracebacks to show source lines
@@ -188,34 +513,156 @@ def worker_main(worker_conn):
     """
     worker_globals = {}
     code_cache = {}
-    stdout = Tty_buffer(Fd_pipe_wrapper(worker_conn, STDOUT_FILENO))
-    stderr = Tty_buffer(Fd_pipe_wrapper(worker_conn, STDERR_FILENO))
+    writer = Frame_writer(worker_conn, ring=ring)
+    writer_lock = threading.Lock()
+    stdout = Tty_buffer(Fd_pipe_wrapper(writer, STDOUT_FILENO),
+                        lock=writer_lock)
+    stderr = Tty_buffer(Fd_pipe_wrapper(writer, STDERR_FILENO),
+                        lock=writer_lock, flush_first=stdout)
     stdin = open("/dev/null", "r")
+    worker_globals["display"] = make_display(writer, stdout, stderr)
+    checkpoints = []
     while True:
         task = worker_conn.recv()
         if not task["do_run"]:
             break
 
+        if "revert_to" in task:
+            # Doesn't return if there's a checkpoint to revert to.
+            revert_to_checkpoint(task["revert_to"], checkpoints)
+            print >>stderr, "There's no checkpoint from before %s." \
+                % task["revert_to"]
+            stderr.flush()
+            with writer_lock:
+                writer.send_eof()
+            continue
+
         code_filename = task["code_filename"]
+        if task.get("checkpoint"):
+            if fork_checkpoint(code_filename, checkpoints, writer_lock):
+                # We are the checkpoint, and have just taken over.
+                print >>stderr, "Reverted to before %s." % code_filename
+                stderr.flush()
+                with writer_lock:
+                    writer.write(PID_FD, str(os.getpid()))
+                    writer.send_eof()
+                continue
+
         code_string = task["code_string"]
         code_cache[code_filename] = code_string.splitlines()
         interpret(code_string, worker_globals,
                   stdin, stdout, stderr,
                   code_filename,
-                  code_cache)
+                  code_cache,
+                  task.get("limits"))
         stdout.flush()
         stderr.flush()
-        worker_conn.send({"eof": True})
+        # The Tty_buffers' flusher threads also write to writer.
+        with writer_lock:
+            writer.send_eof()
+    for label, pid, wake_fd in checkpoints:
+        kill_checkpoint(pid, wake_fd)
+
+
+def make_display(writer, stdout, stderr):
+    """ Return a display() function for code in the worker to call. """
+    def display(data, mime_type="image/png"):
+        """
+        Show data, e.g. a PNG, SVG or HTML string, as a rich output.
+        It goes to the boss in a frame of its own, after the text already
+        printed.
+        """
+        stderr.flush()  # Flushes stdout's lines first.
+        stdout.flush()
+        with stdout.lock:
+            writer.write(DISPLAY_FD, "%s\0%s" % (mime_type, data))
+            writer.flush()
+
+    return display
+
+
+# Most checkpoints a worker keeps; the oldest are dropped first.
+MAX_CHECKPOINTS = 5
+
+
+def fork_checkpoint(label, checkpoints, lock):
+    """
+    Fork a paused copy of this worker, to be woken up if the boss says to
+    revert to it (see revert_to_checkpoint()).  Thanks to copy-on-write,
+    each checkpoint only costs the pages the worker changes afterwards.
+    Append (label, pid, wake_fd) to checkpoints, dropping the oldest
+    beyond MAX_CHECKPOINTS.
+    lock is the lock the output buffers share; it's held over the fork so
+    the copy doesn't start out with it held by a flusher thread.
+
+    Return False in the worker.  In the copy, don't return until woken,
+    then return True; the copy then carries on as the worker, using its
+    inherited ends of the boss's pipe (and ring), while the original exits.
+    """
+    wake_r, wake_w = os.pipe()
+    with lock:
+        pid = os.fork()
+    if pid == 0:
+        os.close(wake_w)
+        while True:
+            try:
+                message = os.read(wake_r, 1)
+                break
+            except OSError as (code, msg):
+                if code != errno.EINTR:
+                    raise
+        if message != "w":
+            # The worker is gone, or dropped this checkpoint.
+            os._exit(0)
+
+        os.close(wake_r)
+        return True
+
+    os.close(wake_r)
+    checkpoints.append( (label, pid, wake_w) )
+    while len(checkpoints) > MAX_CHECKPOINTS:
+        old_label, old_pid, old_wake_fd = checkpoints.pop(0)
+        kill_checkpoint(old_pid, old_wake_fd)
+    return False
+
+
+def kill_checkpoint(pid, wake_fd):
+    os.close(wake_fd)
+    try:
+        os.kill(pid, signal.SIGKILL)
+        os.waitpid(pid, 0)
+    except OSError:
+        # Not our child: we're a checkpoint that took over from its parent.
+        pass
+
+
+def revert_to_checkpoint(label, checkpoints):
+    """
+    If there's a checkpoint labeled label, wake it up to take over as the
+    worker, and exit.  Checkpoints taken after it are dropped.
+    If there's no such checkpoint, just return.
+    """
+    labels = [checkpoint[0] for checkpoint in checkpoints]
+    if label not in labels:
+        return
+
+    i = len(labels) - 1 - labels[::-1].index(label)
+    for newer_label, pid, wake_fd in checkpoints[i + 1:]:
+        kill_checkpoint(pid, wake_fd)
+    os.write(checkpoints[i][2], "w")
+    os._exit(0)
 
 
 def interpret(code_string, worker_globals, stdin, stdout, stderr,
-              code_filename, code_cache):
+              code_filename, code_cache, limits=None):
     """
     Parse the (multi-line) Python code_string, then exec it
         using the given globals dict,
-        and with the given stdio file-like objects.
+        and with the given stdio file-like objects,
+        and under the given limits, if any (see arm_limits()).
     If the last line in code_string is an expression, print its value.
-    Print stack traces from exceptions, including ^C/KeyboardInterrupt/SIGINT.
+    Print stack traces from exceptions, including ^C/KeyboardInterrupt/SIGINT
+    and Limit_exceeded.
     """
     saved_stdin = sys.stdin
     saved_stdout = sys.stdout
@@ -224,7 +671,9 @@ def interpret(code_string, worker_globals, stdin, stdout, stderr,
     sys.stdin = stdin
     sys.stdout = stdout
     sys.stderr = stderr
+    disarm = None
     try:
+        disarm = arm_limits(limits or {})
         tree = ast.parse(code_string, code_filename)
         code1 = code2 = None
         if tree.body and isinstance(tree.body[-1], ast.Expr):
@@ -239,14 +688,128 @@ def interpret(code_string, worker_globals, stdin, stdout, stderr,
         if code2:
             exec code2 in worker_globals
     except:
+        if disarm:
+            disarm_quietly(disarm)
+            disarm = None
         print >>sys.stdout  # Flush and newline.
         worker_print_exc(None, sys.stderr, code_filename, code_cache)
+        if sys.exc_info()[0] == MemoryError \
+                and limits and "memory_bytes" in limits:
+            print >>sys.stderr, "(The task may use %d more bytes of memory.)" \
+                % limits["memory_bytes"]
     finally:
+        if disarm:
+            disarm_quietly(disarm)
         sys.stdin = saved_stdin
         sys.stdout = saved_stdout
         sys.stderr = saved_stderr
 
 
+class Limit_exceeded(BaseException):
+    """
+    Raised within a task that runs past its wall-clock or CPU time limit.
+    Like KeyboardInterrupt, it isn't an Exception, so the task's own
+    "except Exception:" clauses don't swallow it.
+    """
+    pass
+
+
+LIMITS_ARMED = []  # The limits dict of the task being run, if any.
+
+
+def limit_handler(sig_num, stack_frame):
+    if not LIMITS_ARMED:
+        # Too late, the task is over.
+        return
+
+    if sig_num == signal.SIGALRM:
+        raise Limit_exceeded("wall time limit of %g seconds"
+                             % LIMITS_ARMED[0]["wall_seconds"])
+    else:
+        raise Limit_exceeded("CPU time limit of %g seconds"
+                             % LIMITS_ARMED[0]["cpu_seconds"])
+
+
+def arm_limits(limits):
+    """
+    Within the worker, set up the limits for one task.  limits is a dict,
+    any of whose entries may be missing:
+        "wall_seconds": raise Limit_exceeded in the task after this many
+            seconds of real time.  (The boss also kills the worker if
+            the task is still going after WALL_GRACE seconds more.)
+        "cpu_seconds": raise Limit_exceeded after this many more seconds
+            of CPU time, from an ITIMER_PROF timer (SIGPROF).  The soft
+            RLIMIT_CPU is set to the next whole second after that, so the
+            kernel signals (SIGXCPU) the worker too.  (The boss kills the
+            worker if it uses CPU_GRACE seconds more.)
+        "memory_bytes": allow the worker's address space to grow by this
+            many bytes (soft RLIMIT_AS).  Allocations past it fail with
+            MemoryError.
+    Return a function that removes the limits, or None if there are none.
+    """
+    if not limits:
+        return None
+
+    restores = []
+    if "wall_seconds" in limits:
+        signal.signal(signal.SIGALRM, limit_handler)
+        signal.setitimer(signal.ITIMER_REAL, limits["wall_seconds"])
+        restores.append(lambda: signal.setitimer(signal.ITIMER_REAL, 0))
+    if "cpu_seconds" in limits:
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        used = usage.ru_utime + usage.ru_stime
+        signal.signal(signal.SIGPROF, limit_handler)
+        signal.signal(signal.SIGXCPU, limit_handler)
+        signal.setitimer(signal.ITIMER_PROF, limits["cpu_seconds"])
+        restores.append(lambda: signal.setitimer(signal.ITIMER_PROF, 0))
+        restores.append(set_soft_rlimit(resource.RLIMIT_CPU, int(
+                    math.ceil(used + limits["cpu_seconds"]))))
+    if "memory_bytes" in limits:
+        restores.append(set_soft_rlimit(resource.RLIMIT_AS,
+                                        address_space_size()
+                                        + limits["memory_bytes"]))
+    LIMITS_ARMED.append(limits)
+
+    def disarm():
+        del LIMITS_ARMED[:]
+        for restore in restores:
+            restore()
+
+    return disarm
+
+
+def disarm_quietly(disarm):
+    """
+    Call disarm(), from arm_limits().  A limit's signal can still arrive
+    before disarm() has cleared LIMITS_ARMED; the task is over by then,
+    so ignore the Limit_exceeded and finish disarming.
+    """
+    while True:
+        try:
+            disarm()
+            return
+        except Limit_exceeded:
+            pass
+
+
+def set_soft_rlimit(which, soft):
+    """ Lower a soft resource limit; return a function to put it back. """
+    old_soft, hard = resource.getrlimit(which)
+    if hard != resource.RLIM_INFINITY:
+        soft = min(soft, hard)
+    resource.setrlimit(which, (soft, hard))
+    return lambda: resource.setrlimit(which, (old_soft, hard))
+
+
+def address_space_size():
+    """ This process's virtual memory size, if /proc can tell us. """
+    try:
+        pages = int(open("/proc/self/statm").read().split()[0])
+        return pages * resource.getpagesize()
+    except (IOError, ValueError, IndexError):
+        return 0
+
+
 def worker_print_exc(limit=None, file=sys.stderr,
                      code_filename=None, code_cache={}):
     """
@@ -256,6 +819,8 @@ def worker_print_exc(limit=None, file=sys.stderr,
     2) For lines in current or previous tasks (rather than imported modules),
        include the appropriate line's text from code_cache.
        (print_exc() etc. can only fetch lines from actual files.)
+    3) For Limit_exceeded, end with the task's line rather than the
+       signal handler that raised it.
     """
     if code_filename == None:
         traceback.print_exc(limit, file)
@@ -269,6 +834,8 @@ def worker_print_exc(limit=None, file=sys.stderr,
             break
     else:
         tb = []
+    if exc_type == Limit_exceeded:
+        tb = tb[:-1]  # Leave out limit_handler() itself.
     if limit != None:
         tb = tb[:min(len(tb), limit)]
     if tb:
@@ -332,7 +899,8 @@ def middle_manager_test(level=1):
     print self, "stopping."
 
 
-def boss_main(initial_task=None, task_filename="<boss-commands>"):
+def boss_main(initial_task=None, task_filename="<boss-commands>",
+              ring_size=None, limits=None, checkpoint_every=None):
     """
     The main loop for the boss.
     Set up one worker multiprocessing.Process connected with a two-way pipe.
@@ -346,19 +914,26 @@ def boss_main(initial_task=None, task_filename="<boss-commands>"):
         initial_task is a newline-delimited command string for the worker.
     Handle ^C by just relaying it to the worker to interrupt the current task.
         (a second ^C kills the worker and quits entirely).
+    Output comes back through a shared-memory Ring_buffer of ring_size
+    bytes (default RING_SIZE), or through the pipe if that's 0.
+    Every task runs under limits, if given (see arm_limits()).  If the
+    worker dies or has to be killed, a fresh one (with cleared globals)
+    takes its place.
+    If checkpoint_every (default CHECKPOINT_EVERY) is n > 0, the worker
+    takes a checkpoint before every nth input; the input
+        %revert 7
+    then puts the worker back the way it was before <input 7>.
     """
-    boss_conn, worker_conn = multiprocessing.Pipe()
-    worker = multiprocessing.Process(target=worker_main, args=(worker_conn,))
-    worker.start()
-
-    # Detach worker from boss's process group so it doesn't receive the ^C
-    # from the keyboard, but only indirectly from interrupt_worker() below.
-    os.setpgid(worker.pid, worker.pid)
+    if ring_size == None:
+        ring_size = RING_SIZE
+    if checkpoint_every == None:
+        checkpoint_every = CHECKPOINT_EVERY
+    worker, boss_conn, ring = start_worker(ring_size)
     try:
         if initial_task:
             print initial_task
             oversee_one_task(initial_task, worker, boss_conn,
-                             task_filename)
+                             task_filename, ring, limits)
         else:        
             n = 1
             while True:
@@ -367,24 +942,146 @@ def boss_main(initial_task=None, task_filename="<boss-commands>"):
                 if not task_string:
                     break
 
-                oversee_one_task(task_string, worker, boss_conn,
-                                 task_filename)
+                revert_to = None
+                if task_string.startswith("%revert"):
+                    revert_to = "<input %s>" % task_string.split()[-1]
+                checkpoint = checkpoint_every and n % checkpoint_every == 0
+                if not oversee_one_task(task_string, worker, boss_conn,
+                                        task_filename, ring, limits,
+                                        checkpoint, revert_to):
+                    print >>sys.stderr, "Starting a new worker."
+                    worker, boss_conn, ring = start_worker(ring_size)
                 n += 1
-        boss_conn.send({"do_run": False})
+        if worker.is_alive():
+            boss_conn.send({"do_run": False})
         worker.join()
     except KeyboardInterrupt:
         # Normally ^C is caught in oversee_one_task().  We catch it here
         # only if the user hits ^C a second time, or in an unexpected place.
         # That means trouble; make sure the worker is cleaned up.
-        os.kill(worker.pid, signal.SIGKILL)
+        worker.kill()
+
+
+# Take a checkpoint before every this-many tasks in boss_main()'s
+# read-eval-print loop.  0 means never.
+CHECKPOINT_EVERY = 0
+
+
+def start_worker(ring_size=0):
+    """
+    Start a worker process, with a Ring_buffer of ring_size bytes for its
+    output if ring_size isn't 0 (see RING_SIZE).
+    Return a Worker for it, the boss's end of its pipe, and its
+    Ring_buffer or None.
+    """
+    ring = ring_size and Ring_buffer(ring_size) or None
+    boss_conn, worker_conn = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=worker_main,
+                                      args=(worker_conn, ring))
+    process.start()
+
+    # Detach worker from boss's process group so it doesn't receive the ^C
+    # from the keyboard, but only indirectly from interrupt_worker() below.
+    os.setpgid(process.pid, process.pid)
+    return Worker(process), boss_conn, ring
+
+
+class Worker(object):
+    """
+    The boss's handle on the worker process.  Which process that is can
+    change: after a revert, a checkpoint (a child of the original worker,
+    not of the boss) takes over, and announces its pid with a PID_FD frame.
+    """
+    def __init__(self, process):
+        self.process = process
+        self.pid = process.pid
+        self.exitcode = None
+
+    def __repr__(self):
+        return "Worker(%r, pid=%d)" % (self.process, self.pid)
+
+    def switch_to(self, pid):
+        self.process.join()  # The old worker exits when it hands over.
+        self.pid = pid
+
+    def is_alive(self):
+        if self.pid == self.process.pid:
+            return self.process.is_alive()
+
+        try:
+            os.kill(self.pid, 0)
+            return True
+        except OSError:
+            return False
+
+    def join(self):
+        if self.pid == self.process.pid:
+            self.process.join()
+            self.exitcode = self.process.exitcode
+        else:
+            # Not our child, so we can't wait() for it.
+            while self.is_alive():
+                time.sleep(0.01)
+
+    def kill(self):
+        try:
+            os.kill(self.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        self.join()
+
+
+# Where the boss saves rich outputs from display().
+BLOB_DIR = "blobs"
+
+
+def save_blob(data, mime_type):
+    """
+    Save data under BLOB_DIR the way pyinthephone.py keeps its blobs (see
+    blob_store.py).  Return the filename.
+    """
+    extension = blob_store.DISPLAY_TYPES.get(mime_type) \
+        or mimetypes.guess_extension(mime_type) or ""
+    return os.path.join(BLOB_DIR,
+                        blob_store.write_blob(BLOB_DIR, data, extension))
 
 
 DEFAULT_SIGINT_HANDLER = signal.getsignal(signal.SIGINT)
 
+# How long past its wall_seconds limit a task may go, and how much CPU
+# time past its cpu_seconds limit it may use, before the boss gives up
+# on the worker and kills it.
+WALL_GRACE = 2.0
+CPU_GRACE = 2.0
+# How often the boss checks a task's CPU time, if it has a cpu_seconds.
+CPU_CHECK_SECONDS = 0.5
+
+
+def process_cpu_seconds(pid):
+    """ Process pid's user + system CPU time, or None if /proc can't say. """
+    try:
+        # Skip past the command name, which may hold spaces or ")".
+        fields = open("/proc/%d/stat" % pid).read().rsplit(")", 1)[1].split()
+        # fields[0] is field 3, state; utime and stime are fields 14 and 15.
+        return (int(fields[11]) + int(fields[12])) \
+            / float(os.sysconf("SC_CLK_TCK"))
+    except (IOError, IndexError, ValueError):
+        return None
+
 
 def oversee_one_task(task_string, worker, boss_conn,
-                     task_filename):
-    """" Give the worker one task, echo the results, and handle ^C. """
+                     task_filename, ring=None, limits=None,
+                     checkpoint=False, revert_to=None):
+    """
+    Give the Worker one task, echo the results, and handle ^C.
+    The worker enforces limits itself; as a backstop, kill it if the task
+    runs WALL_GRACE seconds past its wall_seconds limit, or uses CPU_GRACE
+    seconds of CPU past its cpu_seconds limit.
+    If checkpoint, the worker takes a checkpoint first.
+    If revert_to is a task_filename, revert to the checkpoint from before
+    that task instead of running task_string.
+    Return False if the worker died or was killed, else True.
+    """
     
     def interrupt_worker(sig_num, stack_frame):
         os.kill(worker.pid, signal.SIGINT)
@@ -393,29 +1090,73 @@ def oversee_one_task(task_string, worker, boss_conn,
 
     print "-----"
     signal.signal(signal.SIGINT, interrupt_worker)
-    boss_conn.send({"do_run": True,
-                    "code_string": task_string,
-                    "code_filename": task_filename,
-                    })
-    while True:
+    if revert_to:
+        boss_conn.send({"do_run": True, "revert_to": revert_to})
+    else:
+        boss_conn.send({"do_run": True,
+                        "code_string": task_string,
+                        "code_filename": task_filename,
+                        "limits": limits,
+                        "checkpoint": checkpoint,
+                        })
+    deadline = None
+    if limits and "wall_seconds" in limits:
+        deadline = time.time() + limits["wall_seconds"] + WALL_GRACE
+    cpu_pid = cpu_deadline = None
+    eof = False
+    while not eof:
         try:
-            # If ^C is hit, it's likely to be while boss_conn.recv() is
-            # blocked waiting for output from the worker.
-            chunk = boss_conn.recv()
-            if chunk["eof"]:
+            if limits and "cpu_seconds" in limits and worker.pid != cpu_pid:
+                # (Again if the worker was switched to a checkpoint.)
+                cpu_pid = worker.pid
+                cpu_deadline = process_cpu_seconds(cpu_pid)
+                if cpu_deadline != None:
+                    cpu_deadline += limits["cpu_seconds"] + CPU_GRACE
+            if deadline and time.time() >= deadline:
+                worker.kill()
+                print >>sys.stderr, "Limit_exceeded: wall time limit of %g" \
+                    " seconds; the worker didn't stop, so it was killed." \
+                    % limits["wall_seconds"]
                 break
 
-            fd, text = chunk["fd"], chunk["text"]
-            if fd == STDOUT_FILENO:
-                sys.stdout.write(text)
-                sys.stdout.flush()
-            elif fd == STDERR_FILENO:
-                sys.stderr.write(text)
-                sys.stderr.flush()
-            else:
-                sys.stderr.write(" FILENO %d? " % fd)
-                sys.stderr.flush()
-                
+            if cpu_deadline and process_cpu_seconds(cpu_pid) >= cpu_deadline:
+                worker.kill()
+                print >>sys.stderr, "Limit_exceeded: CPU time limit of %g" \
+                    " seconds; the worker didn't stop, so it was killed." \
+                    % limits["cpu_seconds"]
+                break
+
+            timeout = None
+            if deadline:
+                timeout = max(0, deadline - time.time())
+            if cpu_deadline and (timeout == None
+                                 or timeout > CPU_CHECK_SECONDS):
+                timeout = CPU_CHECK_SECONDS
+            if timeout != None and not boss_conn.poll(timeout):
+                continue
+
+            # If ^C is hit, it's likely to be while read_frames() is
+            # blocked waiting for output from the worker.
+            for fd, text in read_frames(boss_conn, ring):
+                if fd == EOF_FD:
+                    eof = True
+                    break
+
+                if fd == STDOUT_FILENO:
+                    sys.stdout.write(text)
+                elif fd == STDERR_FILENO:
+                    sys.stderr.write(text)
+                elif fd == PID_FD:
+                    worker.switch_to(int(text))
+                elif fd == DISPLAY_FD:
+                    mime_type, data = text.split("\0", 1)
+                    print "[%s, %d bytes: %s]" \
+                        % (mime_type, len(data), save_blob(data, mime_type))
+                else:
+                    sys.stderr.write(" FILENO %d? " % fd)
+            sys.stdout.flush()
+            sys.stderr.flush()
+
         # Python normally catches both SIGINT itself, and an EINTR that comes
         # from a blocked system call immediately after, raising one exception:
         # KeyboardInterrupt.  interrupt_worker() is set to catch the SIGINT;
@@ -426,7 +1167,16 @@ def oversee_one_task(task_string, worker, boss_conn,
             else:
                 raise
 
+        except EOFError:
+            # E.g. killed by a signal the task didn't handle, or by the
+            # out-of-memory killer.
+            worker.join()
+            print >>sys.stderr, "\nWorker died (exit code %r)." \
+                % worker.exitcode
+            break
+
     signal.signal(signal.SIGINT, DEFAULT_SIGINT_HANDLER)
+    return eof
 
 
 if __name__ == "__main__":
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+"""
+    Tests of pyinthephone.py's request handling, calling its WSGI app()
+    directly rather than through a server.
+
+    Run from the pyinthephone directory:
+        python -m unittest discover -s experiments -p "test_*.py"
+
+    Copyright (c) 2016 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+"""
+
+import sys
+import os
+import shutil
+import zipfile
+import tempfile
+import unittest
+import StringIO
+import wsgiref.util
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                "..", "scripts"))
+import pyinthephone
+import access_log
+from pyinthephone import route
+
+
+@route("/test/raise")
+def do_raise(environ, start_response):
+    raise ValueError("on purpose")
+
+
+def get(path, query=""):
+    """ Return (status, body) of a GET of path from pyinthephone.app(). """
+    environ = {"PATH_INFO": path, "QUERY_STRING": query}
+    wsgiref.util.setup_testing_defaults(environ)
+    statuses = []
+    def start_response(status, headers, exc_info=None):
+        statuses.append(status)
+
+    chunks = pyinthephone.app(environ, start_response)
+    try:
+        body = "".join(chunks)
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+    return statuses[-1], body
+
+
+def requests_total(route_pattern, status):
+    """ The pyinthephone_requests_total counter from /metrics, or 0. """
+    line_start = 'pyinthephone_requests_total{route="%s",status="%s"} ' \
+        % (route_pattern, status)
+    for line in get("/metrics")[1].splitlines():
+        if line.startswith(line_start):
+            return int(line[len(line_start):])
+    return 0
+
+
+class Listed_log(object):
+    """ Stands in for an Access_log, keeping each request's fields. """
+    def __init__(self):
+        self.requests = []
+
+    def log(self, *fields):
+        self.requests.append(dict(zip(access_log.FIELDS, fields)))
+
+
+class Test_errors(unittest.TestCase):
+    def test_raising_handler_is_500_everywhere(self):
+        before = requests_total("/test/raise", "500")
+        status, body = get("/test/raise")
+        self.assertEqual(status, "500 INTERNAL SERVER ERROR")
+        self.assertIn("ValueError: on purpose", body)
+        self.assertEqual(requests_total("/test/raise", "500"), before + 1)
+
+    def test_raising_handler_is_500_in_access_log(self):
+        log = pyinthephone.ACCESS_LOG = Listed_log()
+        try:
+            status, body = get("/test/raise")
+        finally:
+            pyinthephone.ACCESS_LOG = None
+        self.assertEqual(len(log.requests), 1)
+        self.assertEqual(log.requests[0]["status"], status[:3])
+        self.assertEqual(log.requests[0]["bytes"], len(body))
+
+
+class Test_profile(unittest.TestCase):
+    def setUp(self):
+        pyinthephone.DO_DEBUG = True
+
+    def tearDown(self):
+        pyinthephone.DO_DEBUG = False
+
+    def test_bad_numbers_are_400(self):
+        for query in "seconds=abc", "interval=nan", "top=1.5":
+            status, body = get("/debug/profile", query)
+            self.assertEqual(status, "400 BAD REQUEST", query)
+
+    def test_numbers_are_clamped(self):
+        status, body = get("/debug/profile", "seconds=-5&top=-3")
+        self.assertEqual(status, "200 OK")
+
+
+class Test_bundle(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.directory, "notes"))
+        for name in "x.py", "y.txt":
+            path = os.path.join(self.directory, "notes", name)
+            open(path, "w").write(name + "\n")
+        relative = os.path.relpath(self.directory)
+        # ../../tmp/.../notes/x.py, /tmp/.../notes/y.txt and
+        # notes/../../tmp/.../notes/x.py
+        self.paths = [os.path.join(relative, "notes", "x.py"),
+                      os.path.join(self.directory, "notes", "y.txt"),
+                      os.path.join("notes", "..", relative, "notes", "x.py")]
+        self.saved = (pyinthephone.ALLOWED_FILES, pyinthephone.FILE_LISTING)
+        pyinthephone.allow_indexed_files(self.paths)
+
+    def tearDown(self):
+        pyinthephone.ALLOWED_FILES, pyinthephone.FILE_LISTING = self.saved
+        shutil.rmtree(self.directory)
+
+    def test_names_stay_inside(self):
+        status, body = get("/bundle.zip")
+        self.assertEqual(status, "200 OK")
+        archive = zipfile.ZipFile(StringIO.StringIO(body))
+        names = archive.namelist()
+        self.assertEqual(len(names), 2)
+        for name in names:
+            self.assertNotIn("..", name)
+            self.assertFalse(name.startswith("/"))
+        self.assertEqual(sorted(archive.read(name) for name in names),
+                         ["x.py\n", "y.txt\n"])
+
+
+if __name__ == "__main__":
+    unittest.main()
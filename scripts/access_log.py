@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+""" access_log.py
+    Copyright (c) 2013 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+
+An access log of JSON lines, one per request, written by a background
+thread so that request threads never wait on the disk (or console).
+
+A request only appends a tuple to a deque, which needs no lock.  Every
+interval seconds the writer thread takes what has piled up, turns it into
+JSON lines and writes them all at once.  When the file passes max_bytes it
+is renamed to name.1 (name.1 to name.2, and so on, up to keep files) and a
+new one started.
+"""
+
+import os
+import json
+import time
+import atexit
+import threading
+import collections
+
+
+# The fields of each line, in the order Access_log.log() takes them.
+FIELDS = ["time", "method", "path", "route", "status", "bytes", "ms",
+          "remote", "session"]
+
+
+class Access_log(object):
+    def __init__(self, filename, max_bytes=10 * 2**20, keep=3, interval=0.5):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.interval = interval
+        self.pending = collections.deque()
+        self.file = open(filename, "a")
+        writer = threading.Thread(target=self.writer)
+        writer.daemon = True
+        writer.start()
+        atexit.register(self.write_pending)
+
+    def __repr__(self):
+        return "Access_log(%r, max_bytes=%d)" % (self.filename, self.max_bytes)
+
+    def log(self, *fields):
+        """ Queue one request's FIELDS to be written. """
+        self.pending.append(fields)
+
+    def writer(self):
+        while True:
+            time.sleep(self.interval)
+            self.write_pending()
+
+    def write_pending(self):
+        lines = []
+        while self.pending:
+            fields = self.pending.popleft()
+            lines.append(json.dumps(dict(zip(FIELDS, fields)),
+                                    sort_keys=True) + "\n")
+        if lines:
+            self.file.write("".join(lines))
+            self.file.flush()
+            if self.file.tell() >= self.max_bytes:
+                self.rotate()
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.keep - 1, 0, -1):
+            older = "%s.%d" % (self.filename, i)
+            if os.path.exists(older):
+                os.rename(older, "%s.%d" % (self.filename, i + 1))
+        os.rename(self.filename, self.filename + ".1")
+        self.file = open(self.filename, "a")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+""" blob_store.py
+    Copyright (c) 2013 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+
+Rich outputs from display() ("blobs"), kept in a directory under names
+made from their sha1 and an extension for their type.  Storing the same
+data again costs nothing.  Both pyinthephone.py and
+experiments/boss_worker.py keep their blobs this way.
+"""
+
+import os
+import re
+import hashlib
+
+
+# The types display() can show => the extension their blobs get.
+DISPLAY_TYPES = {
+    "image/png": ".png",
+    "image/jpeg": ".jpg",
+    "image/gif": ".gif",
+    "image/svg+xml": ".svg",
+    "text/html": ".html",
+    }
+
+BLOB_NAME = re.compile(r"^[0-9a-f]{40}\.[a-z]+$")
+
+
+def blob_name(data, extension):
+    return hashlib.sha1(data).hexdigest() + extension
+
+
+def write_blob(directory, data, extension):
+    """ Store data in directory, if it isn't there yet; return its name. """
+    name = blob_name(data, extension)
+    path = os.path.join(directory, name)
+    if not os.path.exists(path):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        with open(path + ".tmp", "wb") as blob:
+            blob.write(data)
+        os.rename(path + ".tmp", path)
+    return name
+
+
+def read_blob(directory, name):
+    """ Return the data stored in directory under name, or None. """
+    if not BLOB_NAME.match(name):
+        return None
+
+    path = os.path.join(directory, name)
+    if os.path.exists(path):
+        return open(path, "rb").read()
@@ -0,0 +1,227 @@
+#!/usr/bin/env python
+""" file_index.py
+    Copyright (c) 2013 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+
+An index of the files under some directories, or matching some glob
+patterns, kept up to date by rescanning (see pyinthephone.py's
+allow_files()).
+
+Rescans are incremental: a directory is listed again only if its mtime
+has changed, which is what happens when a file is added to, removed from
+or renamed in it.  Otherwise its listing from the last scan is reused, so
+a rescan costs one stat() per directory rather than one per file.  (A
+file whose contents change keeps its place in its directory; the server
+notices that itself, per request.)
+
+Names starting with "." are left out, as glob leaves them out, and
+symbolic links to directories aren't followed.
+"""
+
+import os
+import re
+import time
+import glob
+import threading
+
+
+# A directory whose mtime is this close to the time it was listed may
+# change again without its mtime changing (on filesystems that keep
+# mtimes to the second, or two), so its listing isn't trusted next scan.
+MTIME_SLOP = 2.0
+
+
+def is_pattern(name):
+    """ Is name a directory or glob pattern, rather than a file? """
+    return glob.has_magic(name) or os.path.isdir(name)
+
+
+class File_index(object):
+    """
+    The files matching any of patterns, each a directory (meaning
+    everything below it) or a glob pattern, where "**" matches any number
+    of directories.  scan() brings the index up to date; paths is the
+    sorted list of matching files.
+    """
+    def __init__(self, patterns):
+        self.patterns = patterns
+        self.roots = []  # [(directory, depth or None, regex or None)]
+        for pattern in patterns:
+            self.roots.append(parse_pattern(pattern))
+        self.listings = {}  # directory => (mtime, list time, files, subdirs)
+        self.paths = []
+        self.n_scans = 0
+        self.n_listed = 0
+
+    def __repr__(self):
+        return "File_index(%r)" % self.patterns
+
+    def scan(self):
+        """
+        Rescan the directories, listing only those that changed.
+        Return whether paths changed.
+        """
+        seen = set()
+        changed = [False]
+        paths = set()
+        for root, depth, regex in self.roots:
+            self.walk(root, depth, regex, seen, changed, paths)
+        for directory in list(self.listings):
+            if directory not in seen:
+                del self.listings[directory]
+                changed[0] = True
+        self.n_scans += 1
+        if changed[0]:
+            self.paths = sorted(paths)
+        return changed[0]
+
+    def walk(self, directory, depth, regex, seen, changed, paths):
+        """
+        Add the matching files in directory and (down to depth more levels,
+        if depth isn't None) below it to paths.  Record each directory
+        visited in seen, and set changed[0] if any listing changed.
+        """
+        seen.add(directory)
+        try:
+            mtime = os.stat(directory or ".").st_mtime
+        except OSError:
+            return
+
+        listing = self.listings.get(directory)
+        if not listing or listing[0] != mtime \
+                or listing[1] - listing[0] < MTIME_SLOP:
+            listing = self.list(directory, mtime)
+            if not self.listings.get(directory) \
+                    or self.listings[directory][2:] != listing[2:]:
+                changed[0] = True
+            self.listings[directory] = listing
+
+        mtime, listed, files, subdirs = listing
+        if depth == 0 or depth == None:
+            for path in files:
+                if not regex or regex.match(path):
+                    paths.add(path)
+        if depth != 0:
+            for subdir in subdirs:
+                self.walk(subdir, depth and depth - 1, regex, seen, changed,
+                          paths)
+
+    def list(self, directory, mtime):
+        """ Return a listing tuple for directory (see __init__). """
+        self.n_listed += 1
+        listed = time.time()
+        files = []
+        subdirs = []
+        try:
+            names = os.listdir(directory or ".")
+        except OSError:
+            names = []
+        for name in sorted(names):
+            if name.startswith("."):
+                continue
+
+            path = os.path.join(directory, name)
+            if os.path.isdir(path):
+                if not os.path.islink(path):
+                    subdirs.append(path)
+            elif os.path.isfile(path):
+                files.append(path)
+        return mtime, listed, files, subdirs
+
+    def start(self, interval, callback):
+        """
+        Rescan every interval seconds in a background thread, calling
+        callback(paths) whenever paths changes.
+        """
+        def scanner():
+            while True:
+                time.sleep(interval)
+                if self.scan():
+                    callback(self.paths)
+
+        thread = threading.Thread(target=scanner)
+        thread.daemon = True
+        thread.start()
+
+
+def parse_pattern(pattern):
+    """
+    Return (directory, depth, regex) for a directory or glob pattern:
+    where to start walking, how many levels below it matching files are
+    (None for any number), and a regex paths must match (None for all).
+    """
+    pattern = os.path.normpath(pattern)
+    if pattern == ".":
+        pattern = ""
+    if not glob.has_magic(pattern):
+        return pattern, None, None
+
+    parts = pattern.split(os.sep)
+    fixed = 0
+    while not glob.has_magic(parts[fixed]):
+        fixed += 1
+    directory = os.sep.join(parts[:fixed])
+    if pattern.startswith(os.sep) and not directory:
+        directory = os.sep
+    if "**" in parts[fixed:]:
+        depth = None
+    else:
+        depth = len(parts) - fixed - 1
+    return directory, depth, re.compile(glob_regex(parts))
+
+
+def glob_regex(parts):
+    """
+    Return a regex matching paths that match the glob pattern parts,
+    where "*" and "?" don't match os.sep, and a part "**" matches any
+    number of directories.
+    """
+    sep = re.escape(os.sep)
+    regex = ""
+    for i, part in enumerate(parts):
+        if part == "**":
+            if i == len(parts) - 1:
+                regex += ".*"
+            else:
+                regex += "(?:[^%s]*%s)*" % (sep, sep)
+            continue
+
+        regex += glob_part_regex(part, sep)
+        if i < len(parts) - 1:
+            regex += sep
+    return regex + r"\Z"
+
+
+def glob_part_regex(part, sep):
+    """ Like fnmatch.translate(part), but "*" and "?" don't match sep. """
+    regex = ""
+    i = 0
+    while i < len(part):
+        c = part[i]
+        i += 1
+        if c == "*":
+            regex += "[^%s]*" % sep
+        elif c == "?":
+            regex += "[^%s]" % sep
+        elif c == "[":
+            end = i
+            if part[end:end + 1] == "!":
+                end += 1
+            if part[end:end + 1] == "]":
+                end += 1
+            end = part.find("]", end)
+            if end < 0:
+                regex += "\\["
+                continue
+
+            chars = part[i:end].replace("\\", "\\\\")
+            if chars.startswith("!"):
+                chars = "^" + chars[1:]
+            elif chars.startswith("^"):
+                chars = "\\" + chars
+            regex += "[%s]" % chars
+            i = end + 1
+        else:
+            regex += re.escape(c)
+    return regex
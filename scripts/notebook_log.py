@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+""" notebook_log.py
+    Copyright (c) 2013 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+
+A notebook's transactions (see pyinthephone.py), kept on disk so they
+survive a restart of the server.
+
+Two files make up a log:
+    name          the transactions, each a 4-byte length followed by that
+                  many bytes of pickle, only ever appended to.
+    name.index    one 8-byte offset into name per cell, in cell order.
+
+Editing a cell appends its new transaction and overwrites the cell's
+offset in the index; the old transaction stays behind as history.
+
+Reopening a log just mmaps the index, so it takes the same time for 100k
+cells as for ten.  A transaction is read and unpickled only when someone
+asks for that cell, e.g. when it's rendered.
+"""
+
+import os
+import mmap
+import struct
+import threading
+import cPickle
+
+
+LENGTH = struct.Struct("!I")
+OFFSET = struct.Struct("!Q")
+
+
+class Notebook_log(object):
+    """
+    A list-like sequence of transactions backed by a log file (see above).
+    Supports len(), log[i], log[i] = transaction, log.append(transaction)
+    and iteration.  Safe to use from several threads.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.index_filename = filename + ".index"
+        self.lock = threading.Lock()
+        self.data = open_for_append(filename)
+        if not os.path.exists(self.index_filename) \
+                and os.path.getsize(filename):
+            rebuild_index(filename, self.index_filename)
+        self.index = open_for_append(self.index_filename)
+
+        # Cells from before this run are located through the mmap, cells
+        # added since through new_offsets.
+        self.mapped = None
+        self.n_mapped = self.usable_length()
+        if self.n_mapped:
+            self.mapped = mmap.mmap(self.index.fileno(),
+                                    self.n_mapped * OFFSET.size)
+        self.new_offsets = []
+
+    def usable_length(self):
+        """
+        Return how many cells the index has, ignoring a last entry that
+        a crash left half-written, or that points past the end of the
+        data.  (The data is always written before its index entry.)
+        """
+        n = os.path.getsize(self.index_filename) // OFFSET.size
+        data_size = os.path.getsize(self.filename)
+        while n:
+            self.index.seek((n - 1) * OFFSET.size)
+            offset, = OFFSET.unpack(self.index.read(OFFSET.size))
+            self.data.seek(offset)
+            header = self.data.read(LENGTH.size)
+            if len(header) == LENGTH.size \
+                    and offset + LENGTH.size + LENGTH.unpack(header)[0] \
+                        <= data_size:
+                break
+
+            n -= 1
+        self.index.truncate(n * OFFSET.size)
+        return n
+
+    def __len__(self):
+        return self.n_mapped + len(self.new_offsets)
+
+    def offset(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("notebook log index out of range")
+
+        if i < self.n_mapped:
+            return OFFSET.unpack_from(self.mapped, i * OFFSET.size)[0]
+        else:
+            return self.new_offsets[i - self.n_mapped]
+
+    def __getitem__(self, i):
+        with self.lock:
+            self.data.seek(self.offset(i))
+            length, = LENGTH.unpack(self.data.read(LENGTH.size))
+            return cPickle.loads(self.data.read(length))
+
+    def __iter__(self):
+        for i in xrange(len(self)):
+            yield self[i]
+
+    def write_transaction(self, transaction):
+        """ Append transaction to the data file and return its offset. """
+        text = cPickle.dumps(tuple(transaction), cPickle.HIGHEST_PROTOCOL)
+        self.data.seek(0, os.SEEK_END)
+        offset = self.data.tell()
+        self.data.write(LENGTH.pack(len(text)) + text)
+        self.data.flush()
+        return offset
+
+    def append(self, transaction):
+        with self.lock:
+            offset = self.write_transaction(transaction)
+            self.index.seek(0, os.SEEK_END)
+            self.index.write(OFFSET.pack(offset))
+            self.index.flush()
+            self.new_offsets.append(offset)
+
+    def __setitem__(self, i, transaction):
+        with self.lock:
+            self.offset(i)  # Check the index.
+            if i < 0:
+                i += len(self)
+            offset = self.write_transaction(transaction)
+            if i < self.n_mapped:
+                OFFSET.pack_into(self.mapped, i * OFFSET.size, offset)
+            else:
+                self.index.seek(i * OFFSET.size)
+                self.index.write(OFFSET.pack(offset))
+                self.index.flush()
+                self.new_offsets[i - self.n_mapped] = offset
+
+    def close(self):
+        if self.mapped:
+            self.mapped.close()
+        self.index.close()
+        self.data.close()
+
+
+def open_for_append(filename):
+    """
+    Open filename (creating it if need be) for reading and for writing
+    anywhere in it.
+    """
+    if not os.path.exists(filename):
+        open(filename, "wb").close()
+    return open(filename, "r+b")
+
+
+def rebuild_index(filename, index_filename):
+    """
+    Write an index for every transaction in the data file filename.
+    Only needed if the index file was lost; this reads the whole log.
+    Edits can't be told from new cells this way, so each comes back as
+    a cell of its own.
+    """
+    offsets = []
+    with open(filename, "rb") as data:
+        while True:
+            offset = data.tell()
+            header = data.read(LENGTH.size)
+            if len(header) < LENGTH.size:
+                break
+
+            length, = LENGTH.unpack(header)
+            if len(data.read(length)) < length:
+                break
+
+            offsets.append(OFFSET.pack(offset))
+    with open(index_filename, "wb") as index:
+        index.write("".join(offsets))
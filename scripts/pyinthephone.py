@@ -25,7 +25,7 @@ download.
 This code is insecure!
     It can run on publicly-reachable URLs instead of 127.0.0.1.
     It displays at least one Unix environment variable (PWD).
-    It shows Python stack traces on the python and 404 pages.
+    It shows Python stack traces on the python and error pages.
     It runs any Python code you give it.
     Besides python, it may be vulnerable to code-injection attacks
         (although I made some vague gestures).
@@ -33,9 +33,40 @@ This code is insecure!
     make this script display its own source code.
 """
 
+import sys
+import time
+import __builtin__
+
+# For --startup-times, time the loading of each module while this file's
+# own imports run (only then is __import__ wrapped).
+START_TIME = time.time()
+IMPORT_TIMES = []  # [depth, module name, seconds], in order of starting.
+IMPORT_DEPTH = [0]
+REAL_IMPORT = __builtin__.__import__
+
+def timed_import(name, *pargs, **kargs):
+    if name in sys.modules:
+        return REAL_IMPORT(name, *pargs, **kargs)
+
+    entry = [IMPORT_DEPTH[0], name, None]
+    IMPORT_TIMES.append(entry)
+    IMPORT_DEPTH[0] += 1
+    start = time.time()
+    try:
+        return REAL_IMPORT(name, *pargs, **kargs)
+    finally:
+        IMPORT_DEPTH[0] -= 1
+        entry[2] = time.time() - start
+
+__builtin__.__import__ = timed_import
+
 import optparse
 usage = """\
 usage: %prog [options] [files to serve...]--PyInThePhone back end.
+
+Each file to serve can also be a directory, meaning all the files below
+it, or a glob pattern (quoted), in which "**" matches any number of
+directories.  These are rescanned for new and removed files while serving.
 """
 optparser = optparse.OptionParser(usage=usage)
 optparser.add_option("--public", action="store_true", default=False,
@@ -44,18 +75,102 @@ optparser.add_option("--python", action="store_true", default=False,
                    help="Serve a working Python interpreter page.")
 optparser.add_option("--port", type=int, default=8000,
                    help="What TCP port to serve on (default=%default).")
+optparser.add_option("--threads", action="store_true", default=False,
+                   help="Handle each request in its own thread.")
+optparser.add_option("--parallel", type=int, default=0,
+                   help="With --threads, run independent Python cells "
+                        "that overlap in time in a pool of this many "
+                        "processes (default=%default, i.e., no pool).")
+optparser.add_option("--memoize", type=float, default=0, metavar="MBYTES",
+                   help="Cache the outputs and resulting globals of Python "
+                        "cells, up to this many megabytes, and replay them "
+                        "when a cell is re-run with the same inputs.  "
+                        "Put #nomemo in a cell to always really run it.")
+optparser.add_option("--access-log", metavar="FILE",
+                   help="Log each request as a line of JSON in FILE, "
+                        "instead of the usual line on stderr.")
+optparser.add_option("--access-log-mbytes", type=float, default=10,
+                   help="Start a new access log when it reaches this size "
+                        "(default=%default), keeping three old ones.")
+optparser.add_option("--debug", action="store_true", default=False,
+                   help="Serve the /debug/ pages: /debug/profile?seconds=N "
+                        "(use with --threads) and /debug/memory.")
+optparser.add_option("--notebook", metavar="FILE",
+                   help="Keep the Python notebook's cells in FILE (and "
+                        "FILE.index), so they are still there after a "
+                        "restart.  Their outputs are kept, not re-run.")
+optparser.add_option("--scan-seconds", type=float, default=5,
+                   help="How often to rescan directories and glob patterns "
+                        "of files to serve (default=%default).")
+optparser.add_option("--startup-times", action="store_true", default=False,
+                   help="Print how long loading each module took, and how "
+                        "long it was till the server was listening.")
 import wsgiref.simple_server
+import wsgiref.handlers
+import wsgiref.util
+import SocketServer
+import threading
 import os
 from sys import argv, exit, stderr
-import sys
-import mimetypes
-import cgi
-import traceback
-import StringIO
-import ast
-import socket
+import types
+import re
+import gc
+import bisect
+try:
+    import tracemalloc  # Python 3.4 and up, or a patched Python 2.
+except ImportError:
+    tracemalloc = None
 
 from makeargv import make_argv
+import file_index  # allow_files() needs it as soon as there are files.
+
+__builtin__.__import__ = REAL_IMPORT
+
+
+class Lazy_module(object):
+    """
+    Stands in for a module that only some routes or options need, e.g.
+    cgi for POSTs, so that starting the server doesn't wait to load it.
+    The first use of one of its attributes imports the module and puts it
+    in this file's globals in place of the Lazy_module.
+    """
+    def __init__(self, name):
+        self.lazy_name = name
+
+    def __repr__(self):
+        return "Lazy_module(%r)" % self.lazy_name
+
+    def __getattr__(self, attribute):
+        start = time.time()
+        module = __import__(self.lazy_name)
+        IMPORT_TIMES.append( [0, self.lazy_name + " (on first use)",
+                              time.time() - start] )
+        globals()[self.lazy_name] = module
+        return getattr(module, attribute)
+
+
+mimetypes = Lazy_module("mimetypes")              # /static, /download
+cgi = Lazy_module("cgi")                          # POSTs, and HTML escaping
+traceback = Lazy_module("traceback")              # Errors
+StringIO = Lazy_module("StringIO")                # /python
+ast = Lazy_module("ast")                          # /python
+cPickle = Lazy_module("cPickle")                  # --parallel, --memoize
+hashlib = Lazy_module("hashlib")                  # --memoize, display()
+multiprocessing = Lazy_module("multiprocessing")  # --parallel
+socket = Lazy_module("socket")                    # --public
+urlparse = Lazy_module("urlparse")                # Query strings
+urllib = Lazy_module("urllib")                    # /download links
+base64 = Lazy_module("base64")                    # display()
+cProfile = Lazy_module("cProfile")                # %prun
+pstats = Lazy_module("pstats")                    # %prun
+timeit = Lazy_module("timeit")                    # %timeit
+resource = Lazy_module("resource")                # /python metrics
+csv = Lazy_module("csv")                          # /python/metrics.csv
+json = Lazy_module("json")                        # /python/metrics.json
+notebook_log = Lazy_module("notebook_log")        # --notebook
+access_log = Lazy_module("access_log")            # --access-log
+zip_stream = Lazy_module("zip_stream")            # /bundle.zip
+blob_store = Lazy_module("blob_store")            # display()
 
 
 REQUIRED_ENV_VARS = [
@@ -78,11 +193,18 @@ INTERESTING_ENV_VARS = [
     "HTTP_USER_AGENT",
     "PWD",
     "REMOTE_HOST",
+    "HTTP_IF_NONE_MATCH",
+    "wsgi.file_wrapper",
     ]
 
 TYPICAL_FILES_TO_SERVE = [
     "scripts/pyinthephone.py",
     "scripts/makeargv.py",
+    "scripts/notebook_log.py",
+    "scripts/access_log.py",
+    "scripts/file_index.py",
+    "scripts/zip_stream.py",
+    "scripts/blob_store.py",
     "scripts/pyinthephone_private.py",
     "scripts/pyinthephone_files.py",
     "scripts/pyinthephone_public.py",
@@ -169,6 +291,7 @@ def fill_template(template, safe_dict, raw_dict={}):
     
 
 ROUTES = {}
+ROUTE_PATTERNS = {}  # ROUTES key => the path_pattern route() was given.
 
 def route(path_pattern):
     """
@@ -209,20 +332,142 @@ def route(path_pattern):
     
     def route_setter(handler):
         ROUTES[path_pattern] = handler
+        ROUTE_PATTERNS[path_pattern] = path_pattern
         if path_pattern.endswith("/") and path_pattern != "/":
             # If, e.g., "/foo/", also match "/foo".
             ROUTES[path_pattern[:-1]] = handler
+            ROUTE_PATTERNS[path_pattern[:-1]] = path_pattern
         return handler  # Unchanged.
 
     return route_setter
 
 
-ALLOWED_FILES = set()
+ALLOWED_FILES = {}  # path => File_info, or None if it couldn't be stat()ed.
+LISTED_FILES = []   # Files given by name, rather than by directory or glob.
+FILE_INDEX = None   # A file_index.File_index of the directories and globs.
+# (ALLOWED_FILES's paths sorted, {(prefix, q, page): (HTML, matches)})
+# for list_files(); replaced whole, along with ALLOWED_FILES.
+FILE_LISTING = ([], {})
+
+def allow_files(files, scan_seconds=5):
+    """
+    Allow files, each a file, a directory or a glob pattern.  The
+    directories and glob patterns are scanned now and every scan_seconds.
+    The files' File_infos are left for file_info() to make when they're
+    first asked for, so that starting up doesn't load mimetypes.
+    """
+    global FILE_INDEX
 
-def allow_files(files):
+    patterns = []
     for file in files:
         assert file != ""
-        ALLOWED_FILES.add(file)
+        if file_index.is_pattern(file):
+            patterns.append(file)
+        else:
+            LISTED_FILES.append(file)
+    if patterns:
+        FILE_INDEX = file_index.File_index(patterns)
+        FILE_INDEX.scan()
+        FILE_INDEX.start(scan_seconds, allow_indexed_files)
+    allow_indexed_files(FILE_INDEX and FILE_INDEX.paths or [])
+
+
+def allow_indexed_files(paths):
+    """
+    Make ALLOWED_FILES the LISTED_FILES plus paths, keeping the File_infos
+    already made.  ALLOWED_FILES's set of paths is never changed in place,
+    only replaced by a new dict, so request threads can use it while the
+    scanner thread calls this.  The only change made in place is
+    file_info() setting the value of a path that's already there.
+    """
+    global ALLOWED_FILES, FILE_LISTING
+
+    old_files = ALLOWED_FILES
+    new_files = {}
+    for some_paths in LISTED_FILES, paths:
+        for path in some_paths:
+            new_files[path] = old_files.get(path)
+    ALLOWED_FILES = new_files
+    FILE_LISTING = (sorted(new_files), {})
+
+
+class File_info(object):
+    """
+    What do_static() and do_download() need to know about an allowed file,
+    worked out when it's first asked for (or changes) instead of per request:
+    its size and mtime, an ETag made from them, and the response headers
+    for viewing it and for downloading it.
+    """
+    def __init__(self, path, stat):
+        self.path = path
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.etag = '"%x-%x"' % (int(stat.st_mtime * 1e6), stat.st_size)
+        common_headers = [
+            ("Content-Length", str(self.size)),
+            ("ETag", self.etag),
+            ("Last-Modified", wsgiref.handlers.format_date_time(self.mtime)),
+            ]
+        self.static_headers = [
+            ("Content-Type",
+             just_guess_type(path) or "application/octet-stream"),
+            ] + common_headers
+
+        download_path = os.path.basename(path)
+        # download_path = download_path.replace("_", "")
+        if os.path.splitext(download_path)[1] in [".py"]:
+            download_path += ".txt"
+        download_path = '"' + download_path + '"'
+        self.download_headers = [
+            ("Content-Disposition", "attachment; filename=%s" % download_path),
+            ("Content-Type", "application/octet-stream"),
+            ] + common_headers
+
+    def __repr__(self):
+        return "File_info(%r, size=%d, mtime=%r)" \
+            % (self.path, self.size, self.mtime)
+
+
+def file_info(path):
+    """
+    Return the File_info for path, made anew if the file's size or mtime
+    has changed, or None if it isn't allowed or can't be stat()ed.
+    The File_info is stored in ALLOWED_FILES under path, which is already
+    there (see allow_indexed_files()).  If the scanner replaces
+    ALLOWED_FILES meanwhile, the File_info is just made again next time.
+    """
+    allowed_files = ALLOWED_FILES
+    if path not in allowed_files:
+        return None
+
+    try:
+        stat = os.stat(path)
+    except OSError:
+        allowed_files[path] = None
+        return None
+
+    info = allowed_files[path]
+    if not info or info.mtime != stat.st_mtime or info.size != stat.st_size:
+        info = allowed_files[path] = File_info(path, stat)
+    return info
+
+
+# Bytes per read when sending a file.
+FILE_BLOCK_SIZE = 65536
+
+def send_file(environ, start_response, info, headers):
+    """
+    Send the file info describes, with headers, a block at a time,
+    or just "304 NOT MODIFIED" if the browser has it already.
+    """
+    if environ.get("HTTP_IF_NONE_MATCH") == info.etag:
+        do_headers(start_response, "304 NOT MODIFIED", None,
+                   ("ETag", info.etag))
+        return []
+
+    do_headers(start_response, "200 OK", None, *headers)
+    file_wrapper = environ.get("wsgi.file_wrapper", wsgiref.util.FileWrapper)
+    return file_wrapper(open(info.path, "rb"), FILE_BLOCK_SIZE)
 
 
 def do_404(environ, start_response, complaint=None):
@@ -234,6 +479,26 @@ def do_404(environ, start_response, complaint=None):
     return chunks
 
 
+def do_400(environ, start_response, complaint):
+    do_headers(start_response, "400 BAD REQUEST", "text/plain")
+    return ["Bad request for %r: %s\n" % (environ["PATH_INFO"], complaint)]
+
+
+def do_500(environ, start_response, complaint=None):
+    """
+    Say the server failed, with complaint (a traceback) if given.  Call it
+    from an except: clause, since it passes the exception on to
+    start_response() in case the failed handler had already called that.
+    """
+    start_response("500 INTERNAL SERVER ERROR",
+                   [("Content-Type", "text/plain")], sys.exc_info())
+    chunks = ["%r failed.\n" % environ["PATH_INFO"]]
+    if complaint:
+        chunks.append("\n" + complaint + "\n")
+
+    return chunks
+
+
 def match_route(path):
     """
     Match path to the appropriate handler callable in the ROUTES table.
@@ -274,15 +539,114 @@ def do_route(environ, start_response):
     Pass the handler an environ dict with "PATH_INFO_MATCHED" and
     "PATH_INFO_TAIL" entries added, corresponding to "matched" and "tail"
     from match_route().
+    Record the request in ROUTE_STATS under the route pattern it matched
+    (as given to route()) and in ACCESS_LOG if there is one.  If the
+    handler raises, send a 500 page with the traceback instead.
     """
-    handler, matched, tail = match_route(environ["PATH_INFO"])
-    if not handler:
-        return do_404(environ, start_response)
+    start = time.time()
+    responses = []
+    def recording_start_response(status, headers, exc_info=None):
+        responses.append( (status, headers) )
+        return start_response(status, headers, exc_info)
+
+    pattern = "(none)"
+
+    def finish(n_bytes):
+        """ Record the request, with the status the client was sent. """
+        status = responses and responses[-1][0][:3] or ""
+        seconds = time.time() - start
+        record_request(pattern, status, n_bytes, seconds)
+        if ACCESS_LOG:
+            ACCESS_LOG.log(start, environ["REQUEST_METHOD"],
+                           environ["PATH_INFO"], pattern, status, n_bytes,
+                           seconds * 1e3, environ.get("REMOTE_ADDR"),
+                           session_id(environ))
+
+    try:
+        handler, matched, tail = match_route(environ["PATH_INFO"])
+        if not handler:
+            chunks = do_404(environ, recording_start_response)
+        else:
+            if tail:
+                pattern = ROUTE_PATTERNS[matched + "*"]
+            else:
+                pattern = ROUTE_PATTERNS[matched]
+            handler_environ = dict(environ)
+            handler_environ["PATH_INFO_MATCHED"] = matched
+            handler_environ["PATH_INFO_TAIL"] = tail
+            chunks = handler(handler_environ, recording_start_response)
+    except Exception:
+        chunks = do_500(environ, recording_start_response,
+                        complaint=traceback.format_exc())
+
+    if isinstance(chunks, list):
+        finish(sum(len(chunk) for chunk in chunks))
+        return chunks
+
+    # A streamed response is recorded once it's been sent.
+    return Recorded_response(chunks, finish)
+
+
+class Recorded_response(object):
+    """
+    A handler's response that isn't a list (e.g. a file or a generator),
+    counting the bytes sent, for finish(n_bytes) to record when the
+    server closes it.
+    """
+    def __init__(self, chunks, finish):
+        self.chunks = chunks
+        self.finish = finish
+        self.n_bytes = 0
+
+    def __iter__(self):
+        for chunk in self.chunks:
+            self.n_bytes += len(chunk)
+            yield chunk
 
-    handler_environ = dict(environ)
-    handler_environ["PATH_INFO_MATCHED"] = matched
-    handler_environ["PATH_INFO_TAIL"] = tail
-    return handler(handler_environ, start_response)
+    def close(self):
+        try:
+            if hasattr(self.chunks, "close"):
+                self.chunks.close()
+        finally:
+            if self.finish:
+                self.finish(self.n_bytes)
+                self.finish = None
+
+
+ACCESS_LOG = None  # An Access_log if --access-log.
+
+def session_id(environ):
+    """
+    There are no logins or session cookies, so tell browsers apart by
+    address and user agent.
+    """
+    return "%08x" % (hash( (environ.get("REMOTE_ADDR"),
+                            environ.get("HTTP_USER_AGENT")) ) & 0xffffffff)
+
+
+# Upper bounds, in seconds, of the request latency histogram's buckets.
+LATENCY_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+# Route pattern => {"statuses": {status: count}, "bytes": response bytes,
+#     "seconds": total latency, "buckets": count per LATENCY_BUCKETS bound,
+#     with one more for slower requests (not cumulative)}.
+ROUTE_STATS = {}
+ROUTE_STATS_LOCK = threading.Lock()
+
+def record_request(pattern, status, n_bytes, seconds):
+    """ Add a request to ROUTE_STATS. """
+    bucket = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+    with ROUTE_STATS_LOCK:
+        stats = ROUTE_STATS.get(pattern)
+        if not stats:
+            stats = ROUTE_STATS[pattern] = {
+                "statuses": {}, "bytes": 0, "seconds": 0.0,
+                "buckets": [0] * (len(LATENCY_BUCKETS) + 1)}
+        stats["statuses"][status] = stats["statuses"].get(status, 0) + 1
+        stats["bytes"] += n_bytes
+        stats["seconds"] += seconds
+        stats["buckets"][bucket] += 1
 
 
 def just_guess_type(filename):
@@ -311,6 +675,8 @@ def app(environ, start_response):
         chunks = do_route(environ, start_response)
         if environ["REQUEST_METHOD"] == "HEAD":
             # I am not going to try to return the correct Content-Length.
+            if hasattr(chunks, "close"):
+                chunks.close()
             return []
 
         return chunks
@@ -318,7 +684,7 @@ def app(environ, start_response):
         exit(1)
         
     except Exception, e:
-        return do_404(environ, start_response,
+        return do_500(environ, start_response,
                       complaint=traceback.format_exc())
 
 
@@ -360,25 +726,166 @@ def dump_environ(environ, start_response):
     return chunks
 
 
+FILES_PER_PAGE = 100
+MAX_CACHED_LISTINGS = 200
+
+FILES_SEARCH = """\
+<form method="get" action="%(action)s">\
+path starts with <input type="text" name="prefix" value="%(prefix)s" />
+and contains <input type="text" name="q" value="%(q)s" />
+<input type="submit" value="show" />\
+</form>
+"""
+
+FILES_BUNDLE = """\
+<p><a href="%(url)s">download these as a ZIP</a></p>
+"""
+
+FILES_LINE = """%(path)s : <a href="%(view)s">view</a>
+                  <a href="%(download)s">download</a><br>
+"""
+
 @route("/static/")
 @route("/download/")
 def list_files(environ, start_response):
-    chunks = html_header(environ, title="Static Files")
+    """
+    List the allowed files, FILES_PER_PAGE at a time.  Query parameters:
+        prefix  only files whose paths start with this,
+        q       only files whose paths contain this, in any case,
+        page    which page, starting from 1.
+    Pages are cached in FILE_LISTING till the allowed files change.
+    """
+    query = urlparse.parse_qs(environ["QUERY_STRING"])
+    prefix = query.get("prefix", [""])[0]
+    q = query.get("q", [""])[0]
+    try:
+        page = max(1, int(query.get("page", [1])[0]))
+    except ValueError:
+        page = 1
+
+    sorted_paths, cache = FILE_LISTING
+    key = (prefix, q, page)
+    # Another thread may clear the cache between any two of these lines.
+    files_html, n_matches = cached = cache.get(key) or \
+        files_page(sorted_paths, prefix, q, page)
+    if key not in cache:
+        if len(cache) >= MAX_CACHED_LISTINGS:
+            cache.clear()
+        cache[key] = cached
 
+    chunks = html_header(environ, title="Static Files")
     chunks.append("<h3>Files available here:</h3>\n")
-    fmt = """%s : <a href=%r>view</a>
-                  <a href=%r>download</a><br>\n"""
-    if ALLOWED_FILES:
-        chunks += [fmt % (path, "/static/" + path, "/download/" + path)
-                 for path in sorted(list(ALLOWED_FILES))]
+    chunks.append(fill_template(FILES_SEARCH, {"action": environ["PATH_INFO"],
+                                               "prefix": prefix, "q": q}))
+    if n_matches:
+        chunks.append(files_page_links(environ["PATH_INFO"], prefix, q, page,
+                                       n_matches))
+        chunks.append(fill_template(FILES_BUNDLE,
+                                    {"url": "/bundle.zip"
+                                     + files_query(prefix, q)}))
+        chunks.append(files_html)
     else:
         chunks.append("(none)<br>\n")
-
     chunks += html_trailer(environ)
 
     do_headers(start_response, "200 OK", "text/html")
     return chunks
 
+
+def files_page(sorted_paths, prefix, q, page):
+    """
+    Return the HTML listing page (from 1) of the sorted_paths that start
+    with prefix and contain q (in any case), and how many there are.
+    """
+    paths = matching_paths(sorted_paths, prefix, q)
+    first = (page - 1) * FILES_PER_PAGE
+    lines = []
+    for path in paths[first:first + FILES_PER_PAGE]:
+        url_path = urllib.quote(path)
+        lines.append(fill_template(FILES_LINE,
+                                   {"path": path,
+                                    "view": "/static/" + url_path,
+                                    "download": "/download/" + url_path}))
+    return "".join(lines), len(paths)
+
+
+def matching_paths(sorted_paths, prefix, q):
+    """
+    Return the sorted_paths that start with prefix and contain q (in any
+    case).
+    """
+    start = bisect.bisect_left(sorted_paths, prefix)
+    if prefix and prefix[-1] != "\xff":
+        # Every path starting with prefix sorts before this.
+        end = bisect.bisect_left(sorted_paths,
+                                 prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        paths = sorted_paths[start:end]
+    else:
+        paths = [path for path in sorted_paths[start:]
+                 if path.startswith(prefix)]
+    if q:
+        q = q.lower()
+        paths = [path for path in paths if q in path.lower()]
+    return paths
+
+
+def files_page_links(action, prefix, q, page, n_matches):
+    """ Return HTML saying which files these are, with previous/next links. """
+    n_pages = (n_matches + FILES_PER_PAGE - 1) // FILES_PER_PAGE
+    first = (page - 1) * FILES_PER_PAGE + 1
+    last = min(page * FILES_PER_PAGE, n_matches)
+    html = "files %d-%d of %d" % (first, last, n_matches)
+    for label, to_page in ("previous", page - 1), ("next", page + 1):
+        if 1 <= to_page <= n_pages:
+            html += fill_template(' &nbsp; <a href="%(url)s">%(label)s</a>',
+                                  {"url": action + files_query(prefix, q,
+                                                               to_page),
+                                   "label": label})
+    return "<p>" + html + "</p>\n"
+
+
+def files_query(prefix, q, page=None):
+    """ Return the query string for list_files() or do_bundle(), or "". """
+    query = []
+    if page:
+        query.append( ("page", page) )
+    if prefix:
+        query.append( ("prefix", prefix) )
+    if q:
+        query.append( ("q", q) )
+    return query and "?" + urllib.urlencode(query) or ""
+
+
+# Not under /download/, where it could hide an allowed file.
+@route("/bundle.zip")
+def do_bundle(environ, start_response):
+    """
+    Send the allowed files whose paths start with ?prefix= and contain ?q=
+    (in any case), or all of them, as a ZIP archive made while sending it.
+    Types in zip_stream.STORED_EXTENSIONS are stored, the rest deflated.
+    """
+    query = urlparse.parse_qs(environ["QUERY_STRING"])
+    prefix = query.get("prefix", [""])[0]
+    q = query.get("q", [""])[0]
+    sorted_paths, cache = FILE_LISTING
+    paths = matching_paths(sorted_paths, prefix, q)
+    if not paths:
+        return do_404(environ, start_response)
+
+    # Allowed paths can be absolute or go up through "..", so name them
+    # in the archive by what's left after archive_name() takes those out.
+    files = []
+    names = set()
+    for path in paths:
+        name = zip_stream.archive_name(path)
+        if name and name not in names:
+            names.add(name)
+            files.append( (name, path) )
+
+    do_headers(start_response, "200 OK", "application/zip",
+               ("Content-Disposition", 'attachment; filename="bundle.zip"'))
+    return zip_stream.zip_stream(files)
+
     
 @route("/static/*")
 def do_static(environ, start_response):
@@ -386,9 +893,9 @@ def do_static(environ, start_response):
     assert not path.endswith("/"), \
         "I don't list directories under " + environ["PATH_INFO_MATCHED"]
 
-    if path in ALLOWED_FILES:
-        do_headers(start_response, "200 OK", just_guess_type(path))
-        return [file(path).read()]
+    info = file_info(path)
+    if info:
+        return send_file(environ, start_response, info, info.static_headers)
     else:
         return do_404(environ, start_response)
 
@@ -399,18 +906,9 @@ def do_download(environ, start_response):
     assert not path.endswith("/"), \
         "I don't list directories under " + environ["PATH_INFO_MATCHED"]
 
-    if path in ALLOWED_FILES:
-        download_path = os.path.basename(path)
-        # download_path = download_path.replace("_", "")
-        if os.path.splitext(download_path)[1] in [".py"]:
-            download_path += ".txt"
-        download_path = '"' + download_path + '"'
-        do_headers(start_response, "200 OK", None,
-                  ("Content-Disposition",
-                    "attachment; filename=%s" % download_path),
-                  ("Content-Type", "application/octet-stream"),
-            )
-        return [file(path).read()]
+    info = file_info(path)
+    if info:
+        return send_file(environ, start_response, info, info.download_headers)
     else:
         return do_404(environ, start_response)
 
@@ -443,11 +941,12 @@ NOTEBOOK_TOP = """
 """
 
 NOTEBOOK_INPUT = """\
-<form method="post" action="">\
+<form method="post" action="/python#anchor">\
 <textarea name="input_text" cols=%(width)s
     style="font-family: monospace; font-size: small;">
 %(python_text)s</textarea>
-<input type="submit" value="run" />\
+<input type="hidden" name="edit_index" value="%(edit_index)s" />\
+<input type="submit" value="%(button)s" />\
 </form>\
 """
 
@@ -455,8 +954,20 @@ NOTEBOOK_FROZEN = """\
 <div style="background-color:%(color)s;">%(text)s</div>\
 """
 
+NOTEBOOK_EDIT_LINK = """\
+<a href="%(edit_url)s" style="font-size: x-small;">edit</a>\
+"""
+
+NOTEBOOK_METRICS = """\
+<div style="font-size: x-small; color: gray; text-align: right;">\
+%(wall)s s, %(cpu)s s CPU, +%(peak_rss_kb)s KB peak RSS, \
+%(output_bytes)s bytes out (%(ran)s)</div>\
+"""
+
 NOTEBOOK_BOTTOM = """\
 <hr>
+<a href="/python/metrics.csv" style="font-size: x-small;">metrics.csv</a> \
+<a href="/python/metrics.json" style="font-size: x-small;">metrics.json</a>
 %(blank_line)s
 </pre>
 </td></tr></table>
@@ -481,11 +992,14 @@ def simple_wrap(text, width, strip=False):
 
 
 NOTEBOOK_GLOBALS = {}  # exec code in NOTEBOOK_GLOBALS
-NOTEBOOK_ABOVE = []
+# Transactions: (input, response, trace, metrics); see interpret().
+# (Logs from before metrics were kept have (input, response, trace).)
+NOTEBOOK_ABOVE = []  # Or a Notebook_log; see serve().
 NOTEBOOK_BELOW = []
 
-def render_notebook_frozen(transaction, width):
-    input, response, trace = transaction
+def render_notebook_frozen(transaction, width, edit_url=None):
+    input, response, trace = transaction[:3]
+    metrics = transaction_metrics(transaction)
     chunks = []
     if not response and not trace:
         response = "\n"
@@ -494,53 +1008,798 @@ def render_notebook_frozen(transaction, width):
             (response, "white", False),
             (trace, "#FFe4e4", False),
             ]:
-        if text:
+        if text and BLOB_MARK in text:
+            chunks.append(render_displays(text, width, color))
+        elif text:
             text = simple_wrap(text, width, strip)
             chunks.append(fill_template(NOTEBOOK_FROZEN, locals()))
+            if edit_url and color == "#e4e4e4":
+                chunks.append(fill_template(NOTEBOOK_EDIT_LINK, locals()))
+    if metrics:
+        wall = "%.3f" % metrics["wall_seconds"]
+        cpu = "%.3f" % metrics["cpu_seconds"]
+        chunks.append(fill_template(NOTEBOOK_METRICS,
+                                    dict(metrics, wall=wall, cpu=cpu)))
     return "".join(chunks)
 
 
-def render_notebook_input(python_text, width):
+def transaction_metrics(transaction):
+    if len(transaction) > 3:
+        return transaction[3]
+    else:
+        return None
+
+
+NOTEBOOK_IMAGE = """\
+<div><img src="%(url)s" style="max-width: 100%%;"></div>\
+"""
+
+NOTEBOOK_HTML = """\
+<iframe src="%(url)s" sandbox width="100%%" frameborder="0"></iframe>\
+"""
+
+def render_displays(text, width, color):
+    """
+    Render output text that has rich outputs from display() in it
+    (see store_displays()), each as an <img> or <iframe> whose URL points
+    at the blob, so the page itself stays small.
+    """
+    chunks = []
+    for i, part in enumerate(text.split("\0")):
+        if i % 2 and part.startswith(BLOB_MARK[1:]):
+            url = "/blob/" + part[len(BLOB_MARK) - 1:]
+            if url.endswith(".html"):
+                chunks.append(fill_template(NOTEBOOK_HTML, locals()))
+            else:
+                chunks.append(fill_template(NOTEBOOK_IMAGE, locals()))
+        elif part.strip("\n"):
+            text = simple_wrap(part, width)
+            chunks.append(fill_template(NOTEBOOK_FROZEN, locals()))
+    return "".join(chunks)
+
+
+def render_notebook_input(python_text, width, edit_index=None):
+    if edit_index == None:
+        edit_index = ""
+        button = "run"
+    else:
+        button = "re-run cell %d and what depends on it" % edit_index
     return fill_template(NOTEBOOK_INPUT, locals())
 
 
+class Thread_output_router(object):
+    """
+    A file-like object installed (once) as sys.stdout or sys.stderr, so
+    that interpret() doesn't have to swap those for the whole process.
+    Writes go to the file the current thread has set with
+    capture_output(), or, if it hasn't, to the file wrapped at startup.
+    So output from notebook cells running in different request threads,
+    and from the server's own logging, doesn't get mixed together.
+    """
+    def __init__(self, default_file):
+        self.default_file = default_file
+
+    def __repr__(self):
+        return "Thread_output_router(%r)" % self.default_file
+
+    def target(self):
+        return getattr(OUTPUT_CAPTURE, "file", None) or self.default_file
+
+    def write(self, text):
+        self.target().write(text)
+
+    def writelines(self, lines):
+        self.target().writelines(lines)
+
+    def flush(self):
+        self.target().flush()
+
+    def __getattr__(self, name):
+        # encoding, isatty(), fileno(), etc.
+        return getattr(self.target(), name)
+
+
+OUTPUT_CAPTURE = threading.local()
+
+def install_output_routers():
+    if not isinstance(sys.stdout, Thread_output_router):
+        sys.stdout = Thread_output_router(sys.stdout)
+    if not isinstance(sys.stderr, Thread_output_router):
+        sys.stderr = Thread_output_router(sys.stderr)
+
+
+def capture_output(file):
+    """
+    Send this thread's sys.stdout and sys.stderr output to file,
+    or back to the real stdout and stderr if file is None.
+    """
+    OUTPUT_CAPTURE.file = file
+
+
 DO_PYTHON = False
 
 def interpret(code_text):
+    """
+    Run code_text as a notebook cell in NOTEBOOK_GLOBALS.
+    Return (output, trace, metrics), where trace is "" unless there was an
+    exception, and metrics is a dict (see measure_start()) or None if the
+    cell didn't parse.
+
+    Cells can be run concurrently from different request threads (see
+    --threads).  A cell waits while any running cell binds a global it
+    uses or uses a global it binds or mutates (see cell_names()).
+    Otherwise it runs right away: in a CELL_POOL process, if there is a
+    pool, other cells are running, the cell doesn't mutate any global in
+    place, and the globals it reads can be pickled; else here.
+
+    With --memoize, a cell whose source and input globals match an earlier
+    run isn't run again; see memo_key().
+
+    A cell starting with a magic (see MAGICS) always runs here, unmemoized.
+    """
     if not DO_PYTHON:
-        return "I'm not doing Python.", ""
+        return "I'm not doing Python.", "", None
     
-    saved_stdout = sys.stdout
-    saved_stderr = sys.stderr
+    magic, python_text = split_magic(code_text)
+    try:
+        tree = ast.parse(python_text, "<your input>")
+    except Exception:
+        return "", unixify_newlines(traceback.format_exc()), None
+
+    CELL_NAMES[code_text] = reads, binds, mutates = cell_names(tree)
+    # Using a module's attributes (math.pi) doesn't count as mutating it.
+    # (Not in CELL_NAMES, since which names are modules can change.)
+    mutates = set(name for name in mutates
+                  if not isinstance(NOTEBOOK_GLOBALS.get(name),
+                                    types.ModuleType))
+    names = reads, binds, mutates
+    others_running = start_cell(names)
+    try:
+        metrics = measure_start()
+        if magic:
+            result = interpret_here(tree, MAGICS[magic])
+            ran = magic
+        else:
+            key, before = memo_key(code_text, names)
+            result = key and memo_replay(key)
+            ran = "memo"
+            if result == None and others_running and CELL_POOL \
+                    and not mutates:
+                result = interpret_in_pool(code_text, names)
+                ran = "pool"
+            if result == None:
+                result = interpret_here(tree)
+                ran = "here"
+            if key and ran != "memo" and not result[1]:
+                memo_store(key, names, before, result)
+    finally:
+        end_cell(names)
+    output, trace = result
+    measure_end(metrics, ran, output, trace)
+    return unixify_newlines(store_displays(output)), \
+        unixify_newlines(trace), metrics
+
+
+def measure_start():
+    """
+    Return a metrics dict for a cell that's starting, with the readings
+    measure_end() will take differences from.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {"wall_seconds": time.time(),
+            "cpu_seconds": usage.ru_utime + usage.ru_stime,
+            "peak_rss_kb": usage.ru_maxrss,
+            }
+
+
+def measure_end(metrics, ran, output, trace):
+    """
+    Turn metrics from measure_start() into what the cell cost:
+        wall_seconds    elapsed time,
+        cpu_seconds     this process's user + system CPU time (so it
+                        includes other threads' cells running at the same
+                        time, and not a CELL_POOL process's),
+        peak_rss_kb     how much the process's peak resident set grew,
+        output_bytes    size of output and traceback,
+        ran             "here", "pool", "memo", or the magic.
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    metrics["wall_seconds"] = time.time() - metrics["wall_seconds"]
+    metrics["cpu_seconds"] = usage.ru_utime + usage.ru_stime \
+        - metrics["cpu_seconds"]
+    metrics["peak_rss_kb"] = usage.ru_maxrss - metrics["peak_rss_kb"]
+    metrics["output_bytes"] = len(output) + len(trace)
+    metrics["ran"] = ran
+
+
+def interpret_here(tree, run=None):
+    """
+    Run a parsed cell in NOTEBOOK_GLOBALS with run(tree, globals)
+    (by default exec_cell()), capturing its output.
+    """
+    install_output_routers()  # In case serve() didn't.
     output = StringIO.StringIO()
     trace = ""
     try:
-        sys.stdout = output
-        sys.stderr = output
-        
-        tree = ast.parse(code_text, "<your input>")
-        code1 = code2 = None
-        if tree.body and isinstance(tree.body[-1], ast.Expr):
-            last_line = ast.Interactive(tree.body[-1:])
-            tree.body = tree.body[:-1]
-            code2 = compile(last_line, "<your input>", "single")
-        if tree.body:
-            code1 = compile(tree, "<your input>", "exec")
-
-        if code1:
-            exec code1 in NOTEBOOK_GLOBALS
-        if code2:
-            exec code2 in NOTEBOOK_GLOBALS
+        capture_output(output)
+        (run or exec_cell)(tree, NOTEBOOK_GLOBALS)
     except Exception, KeyboardInterrupt:
         trace = traceback.format_exc()
     finally:
-        sys.stdout = saved_stdout
-        sys.stderr = saved_stderr
-    return unixify_newlines(output.getvalue()), unixify_newlines(trace)
+        capture_output(None)
+    return output.getvalue(), trace
+
+
+def exec_cell(tree, cell_globals):
+    """
+    Exec a parsed cell in cell_globals.
+    If the last statement is an expression, print its value.
+    """
+    code1 = code2 = None
+    if tree.body and isinstance(tree.body[-1], ast.Expr):
+        last_line = ast.Interactive(tree.body[-1:])
+        tree.body = tree.body[:-1]
+        code2 = compile(last_line, "<your input>", "single")
+    if tree.body:
+        code1 = compile(tree, "<your input>", "exec")
+
+    if code1:
+        exec code1 in cell_globals
+    if code2:
+        exec code2 in cell_globals
+
+
+# The kinds of rich output display() can show, and their blob extensions.
+# display() writes DISPLAY_MARK, the mime type, a space, the data in
+# base64, and "\0" into the cell's output; store_displays() swaps that
+# for BLOB_MARK, the blob's name and "\0".
+DISPLAY_MARK = "\0display "
+BLOB_MARK = "\0blob "
+
+def display(data, mime_type="image/png"):
+    """
+    Show data (a PNG, JPEG, GIF, SVG or HTML string) in the notebook,
+    after whatever the cell has printed so far.
+    Cells see this as the global display().
+    """
+    if mime_type not in blob_store.DISPLAY_TYPES:
+        raise ValueError("display() can't show %r; try one of %s."
+                         % (mime_type,
+                            ", ".join(sorted(blob_store.DISPLAY_TYPES))))
+
+    if isinstance(data, unicode):
+        data = data.encode("utf-8")
+    sys.stdout.write("%s%s %s\0" % (DISPLAY_MARK, mime_type,
+                                    base64.b64encode(data)))
+
+NOTEBOOK_GLOBALS["display"] = display
+
+
+def store_displays(output):
+    """
+    Move the data of display() calls in output into the blob store,
+    leaving just the blobs' names.  (Cells run in a CELL_POOL process, or
+    replayed by memo_replay(), come back with the data inline too.)
+    """
+    if DISPLAY_MARK not in output:
+        return output
+
+    parts = output.split(DISPLAY_MARK)
+    for i in range(1, len(parts)):
+        display, sep, rest = parts[i].partition("\0")
+        mime_type, space, data = display.partition(" ")
+        name = store_blob(base64.b64decode(data),
+                          blob_store.DISPLAY_TYPES[mime_type])
+        parts[i] = "%s%s\0%s" % (BLOB_MARK, name, rest)
+    return "".join(parts)
+
+
+BLOB_DIR = None  # With --notebook, blobs are kept there, else in BLOBS.
+BLOBS = {}
+
+def store_blob(data, extension):
+    """
+    Keep data under a name made from its sha1 and extension (see
+    blob_store.py), and return the name.
+    """
+    if BLOB_DIR == None:
+        name = blob_store.blob_name(data, extension)
+        BLOBS[name] = data
+        return name
+    else:
+        return blob_store.write_blob(BLOB_DIR, data, extension)
+
+
+def load_blob(name):
+    """ Return the data stored under name, or None. """
+    if BLOB_DIR == None:
+        return BLOBS.get(name)
+    else:
+        return blob_store.read_blob(BLOB_DIR, name)
+
+
+@route("/blob/*")
+def do_blob(environ, start_response):
+    """
+    Serve a rich output.  A blob's name is its hash, so its contents never
+    change, and browsers may keep it for good.
+    """
+    name = environ["PATH_INFO_TAIL"]
+    data = load_blob(name)
+    if data == None:
+        return do_404(environ, start_response)
+
+    etag = '"%s"' % name.split(".")[0]
+    cache_headers = [("ETag", etag),
+                     ("Cache-Control", "public, max-age=31536000, immutable")]
+    if environ.get("HTTP_IF_NONE_MATCH") == etag:
+        do_headers(start_response, "304 NOT MODIFIED", None, *cache_headers)
+        return []
+
+    do_headers(start_response, "200 OK", just_guess_type(name),
+               ("Content-Length", str(len(data))), *cache_headers)
+    return [data]
+
+
+def split_magic(code_text):
+    """
+    If code_text starts with one of the MAGICS, e.g.
+        %timeit x.sort()
+    or
+        %prun
+        for i in range(1000):
+            f(i)
+    return the magic and the Python after it, else return None, code_text.
+    """
+    first_line, newline, rest = code_text.lstrip().partition("\n")
+    words = first_line.split(None, 1)
+    if words and words[0] in MAGICS:
+        return words[0], (words[1:] or [""])[0] + newline + rest
+    else:
+        return None, code_text
+
+
+# How long %timeit's timing runs should take, and how many it makes.
+TIMEIT_SECONDS = 0.2
+TIMEIT_REPEAT = 3
+
+def timeit_cell(tree, cell_globals):
+    """
+    Run the cell enough times in a row to take about TIMEIT_SECONDS
+    (1, 10, 100... times), TIMEIT_REPEAT times over, with the garbage
+    collector off as in the timeit module.  Print the best and mean times
+    per run; the cell's own output is thrown away.
+    """
+    code = compile(tree, "<your input>", "exec")
+    timings = []
+    number = 1
+    cell_output = OUTPUT_CAPTURE.file
+    capture_output(StringIO.StringIO())
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        while True:
+            seconds = time_runs(code, cell_globals, number)
+            if seconds >= TIMEIT_SECONDS or number >= 10**9:
+                break
+
+            number *= 10
+        timings.append(seconds)
+        while len(timings) < TIMEIT_REPEAT:
+            timings.append(time_runs(code, cell_globals, number))
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+        capture_output(cell_output)
+
+    best = min(timings) / number
+    mean = sum(timings) / len(timings) / number
+    print "%d loops, best of %d: %s per loop (mean %s)" \
+        % (number, len(timings), format_seconds(best), format_seconds(mean))
+
+
+def time_runs(code, cell_globals, number):
+    start = timeit.default_timer()
+    for i in xrange(number):
+        exec code in cell_globals
+    return timeit.default_timer() - start
+
+
+def format_seconds(seconds):
+    for unit, scale in [("s", 1.0), ("ms", 1e-3), ("usec", 1e-6)]:
+        if seconds >= scale:
+            return "%.3g %s" % (seconds / scale, unit)
+    return "%.3g nsec" % (seconds / 1e-9)
+
+
+# Rows of the %prun table.
+PRUN_LINES = 25
+
+def profile_cell(tree, cell_globals):
+    """
+    Run the cell under cProfile, then print its PRUN_LINES most
+    expensive functions by cumulative time, after the cell's own output.
+    """
+    profiler = cProfile.Profile()
+    try:
+        profiler.runcall(exec_cell, tree, cell_globals)
+    finally:
+        print
+        stats = pstats.Stats(profiler, stream=sys.stdout)
+        stats.sort_stats("cumulative").print_stats(PRUN_LINES)
+
+
+MAGICS = {
+    "%timeit": timeit_cell,
+    "%prun": profile_cell,
+    }
+
+
+# Calls that can read or bind any global at all.
+WILD_NAMES = set(["globals", "locals", "vars", "eval", "execfile",
+                  "__import__", "reload"])
+
+def cell_names(tree):
+    """
+    Return (reads, binds, mutates): the sets of global names a parsed cell
+    may use, may bind (assign, del, def, import...), and may change the
+    object of in place (x.append(1), x[0] = 1, x.a = 1, x += [1]).  This
+    errs on the side of too many names: a name loaded anywhere counts as
+    read, and a name stored anywhere, even as a function's local, counts
+    as bound.
+    The exception is a name loaded after a top-level statement has surely
+    bound it (x = ..., import x, def x...), since then the cell doesn't
+    depend on what x was before.
+    "*" in binds means the cell might bind anything.
+    Mutating an object other ways, e.g. by passing it to a function,
+    isn't seen here; see interpret_in_pool() and memo_store().
+    """
+    reads = set()
+    binds = set()
+    mutates = set()
+    surely_bound = set()
+    for statement in tree.body:
+        for node in ast.walk(statement):
+            if isinstance(node, ast.Name):
+                if isinstance(node.ctx, ast.Load):
+                    if node.id not in surely_bound:
+                        reads.add(node.id)
+                    if node.id in WILD_NAMES:
+                        binds.add("*")
+                else:
+                    binds.add(node.id)
+            elif isinstance(node, ast.AugAssign) \
+                    and isinstance(node.target, ast.Name) \
+                    and node.target.id not in surely_bound:
+                reads.add(node.target.id)
+                mutates.add(node.target.id)
+            elif isinstance(node, (ast.Attribute, ast.Subscript)) \
+                    and isinstance(node.value, ast.Name) \
+                    and node.value.id not in surely_bound:
+                mutates.add(node.value.id)
+            elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+                binds.add(node.name)
+            elif isinstance(node, (ast.Import, ast.ImportFrom)):
+                for alias in node.names:
+                    binds.add(alias.asname or alias.name.split(".")[0])
+            elif isinstance(node, ast.Global):
+                binds.update(node.names)
+            elif isinstance(node, ast.Exec):
+                binds.add("*")
+        surely_bound |= statement_binds(statement)
+    return reads, binds, mutates
+
+
+def statement_binds(statement):
+    """ The names a top-level statement binds if it finishes. """
+    names = set()
+    if isinstance(statement, ast.Assign):
+        for target in statement.targets:
+            for node in ast.walk(target):
+                if isinstance(node, ast.Name):
+                    names.add(node.id)
+    elif isinstance(statement, (ast.FunctionDef, ast.ClassDef)):
+        names.add(statement.name)
+    elif isinstance(statement, (ast.Import, ast.ImportFrom)):
+        for alias in statement.names:
+            names.add(alias.asname or alias.name.split(".")[0])
+    return names
+
+
+CELL_NAMES = {}  # cell_names() of each code_text interpret() has seen.
+
+def names_of(code_text):
+    if code_text not in CELL_NAMES:
+        try:
+            CELL_NAMES[code_text] = cell_names(
+                ast.parse(split_magic(code_text)[1]))
+        except Exception:
+            CELL_NAMES[code_text] = (set(), set(), set())
+    return CELL_NAMES[code_text]
+
+
+def edit_cell(index, input):
+    """
+    Replace the input of NOTEBOOK_ABOVE[index] and run it.  Then re-run
+    just the later cells that the change could affect: those that use a
+    name bound by the old or new input, or by a cell re-run so far.
+    (Later cells that only bind such a name are re-run too, since running
+    the earlier cell again has clobbered their value.)
+    Cells that mutate objects in place (x.append(1)) will do it again.
+    Return the number of later cells re-run.
+    """
+    reads, binds, mutates = names_of(NOTEBOOK_ABOVE[index][0])
+    dirty = binds | mutates
+    response, trace, metrics = interpret(input)
+    NOTEBOOK_ABOVE[index] = (input, response, trace, metrics)
+    reads, binds, mutates = names_of(input)
+    dirty |= binds | mutates
+    n_rerun = 0
+    for i in range(index + 1, len(NOTEBOOK_ABOVE)):
+        input = NOTEBOOK_ABOVE[i][0]
+        reads, binds, mutates = names_of(input)
+        if "*" in dirty or "*" in binds or not dirty.isdisjoint(reads | binds):
+            response, trace, metrics = interpret(input)
+            NOTEBOOK_ABOVE[i] = (input, response, trace, metrics)
+            dirty |= binds | mutates
+            n_rerun += 1
+    return n_rerun
+
+
+def cells_conflict(names1, names2):
+    """ Mutating a name's object counts as binding it here. """
+    reads1, binds1, mutates1 = names1
+    reads2, binds2, mutates2 = names2
+    changes1 = binds1 | mutates1
+    changes2 = binds2 | mutates2
+    return "*" in binds1 or "*" in binds2 \
+        or not changes1.isdisjoint(reads2 | changes2) \
+        or not changes2.isdisjoint(reads1)
+
+
+RUNNING_CELLS = []  # cell_names() of the cells being run now.
+CELLS_CHANGED = threading.Condition()
+
+def start_cell(names):
+    """
+    Wait till no running cell conflicts with names, then add names to
+    RUNNING_CELLS.  Return whether other cells are running.
+    """
+    with CELLS_CHANGED:
+        while [running for running in RUNNING_CELLS
+               if cells_conflict(running, names)]:
+            CELLS_CHANGED.wait()
+        RUNNING_CELLS.append(names)
+        return len(RUNNING_CELLS) > 1
+
+
+def end_cell(names):
+    with CELLS_CHANGED:
+        RUNNING_CELLS.remove(names)
+        CELLS_CHANGED.notify_all()
+
+
+MEMO_MAX_BYTES = 0  # See --memoize.
+MEMO_BYPASS = "#nomemo"
+MEMO_CACHE = {}  # memo_key() => [last_use, size, output, changes, deleted]
+MEMO_LOCK = threading.Lock()
+MEMO_STATS = {"bytes": 0, "clock": 0, "hits": 0, "misses": 0}
+
+def memo_key(code_text, names):
+    """
+    Return (key, before): a hash of code_text and pickles of the globals
+    it reads, and a dict of those pickles.  Return (None, None) if
+    memoizing is off or the cell can't be memoized: it says #nomemo,
+    might bind any name, or reads something that can't be pickled.
+    """
+    reads, binds, mutates = names
+    if not MEMO_MAX_BYTES or "*" in binds or MEMO_BYPASS in code_text:
+        return None, None
+
+    before = {}
+    digest = hashlib.sha1(code_text)
+    try:
+        for name in sorted(reads):
+            if name in NOTEBOOK_GLOBALS:
+                before[name] = pickle_globals({name: NOTEBOOK_GLOBALS[name]})
+                digest.update("\0%s\0%s" % (name, before[name]))
+    except Exception:
+        return None, None
+
+    return digest.digest(), before
+
+
+def memo_replay(key):
+    """
+    If key is in MEMO_CACHE, put back the globals the cell bound and
+    return its (output, ""), else return None.
+    """
+    with MEMO_LOCK:
+        entry = MEMO_CACHE.get(key)
+        if not entry:
+            MEMO_STATS["misses"] += 1
+            return None
+
+        MEMO_STATS["hits"] += 1
+        MEMO_STATS["clock"] += 1
+        entry[0] = MEMO_STATS["clock"]
+    last_use, size, output, changes_pickle, deleted = entry
+    NOTEBOOK_GLOBALS.update(unpickle_globals(changes_pickle))
+    for name in deleted:
+        NOTEBOOK_GLOBALS.pop(name, None)
+    return output, ""
+
+
+def memo_store(key, names, before, result):
+    """
+    Remember a cell's output and the globals it bound.
+    Then evict least-recently-used entries down to MEMO_MAX_BYTES.
+    A cell that changed a global it only reads (i.e., mutated it in place)
+    isn't remembered, since putting back a copy would break any other
+    names for the same object.
+    """
+    reads, binds, mutates = names
+    changes = {}
+    for name in reads | binds:
+        if name in NOTEBOOK_GLOBALS:
+            try:
+                value_pickle = pickle_globals({name: NOTEBOOK_GLOBALS[name]})
+            except Exception:
+                return
+
+            if before.get(name) != value_pickle:
+                if name not in binds:
+                    return
+
+                changes[name] = NOTEBOOK_GLOBALS[name]
+    deleted = [name for name in before if name not in NOTEBOOK_GLOBALS]
+    output = result[0]
+    changes_pickle = pickle_globals(changes)
+    size = len(key) + len(output) + len(changes_pickle)
+    if size > MEMO_MAX_BYTES:
+        return
+
+    with MEMO_LOCK:
+        if key in MEMO_CACHE:
+            MEMO_STATS["bytes"] -= MEMO_CACHE[key][1]
+        MEMO_STATS["clock"] += 1
+        MEMO_CACHE[key] = [MEMO_STATS["clock"], size, output, changes_pickle,
+                           deleted]
+        MEMO_STATS["bytes"] += size
+        if MEMO_STATS["bytes"] > MEMO_MAX_BYTES:
+            by_age = sorted((entry[0], key)
+                            for key, entry in MEMO_CACHE.items())
+            for last_use, old_key in by_age:
+                if MEMO_STATS["bytes"] <= MEMO_MAX_BYTES:
+                    break
+
+                MEMO_STATS["bytes"] -= MEMO_CACHE.pop(old_key)[1]
+
+
+CELL_POOL = None  # A multiprocessing.Pool if --parallel.
+CELL_POOL_SIZE = 0  # How many processes CELL_POOL has.
+
+def interpret_in_pool(code_text, names):
+    """
+    Run a cell in a CELL_POOL process, with copies of the globals it reads,
+    and merge the globals it binds back into NOTEBOOK_GLOBALS.  Globals it
+    only reads but changed anyway (mutated in place, out of cell_names()'s
+    sight) aren't merged back, since a copy would no longer be the same
+    object as other names for it; they're reported in the trace.
+    Return (output, trace), or None if the globals can't be pickled.
+    """
+    reads, binds, mutates = names
+    try:
+        globals_pickle = pickle_globals(
+            dict((name, NOTEBOOK_GLOBALS[name])
+                 for name in reads if name in NOTEBOOK_GLOBALS))
+    except Exception:
+        return None
+
+    output, trace, changes_pickle, deleted, unpicklable, mutated \
+        = CELL_POOL.apply(pool_interpret, (code_text, globals_pickle, binds))
+    NOTEBOOK_GLOBALS.update(unpickle_globals(changes_pickle))
+    for name in deleted:
+        NOTEBOOK_GLOBALS.pop(name, None)
+    if unpicklable:
+        trace += "\n(Ran in parallel; couldn't bring back: %s.  " \
+                 "Run the cell again by itself for those.)\n" \
+                 % ", ".join(unpicklable)
+    if mutated:
+        trace += "\n(Ran in parallel; changed in place, so not brought " \
+                 "back: %s.  Run the cell again by itself for those.)\n" \
+                 % ", ".join(mutated)
+    return output, trace
+
+
+def pickle_globals(cell_globals):
+    """
+    Pickle a dict of globals.  Modules go by name, to be imported again
+    at the other end.
+    """
+    values = {}
+    modules = {}
+    for name, value in cell_globals.items():
+        if isinstance(value, types.ModuleType):
+            modules[name] = value.__name__
+        else:
+            values[name] = value
+    return cPickle.dumps((values, modules), cPickle.HIGHEST_PROTOCOL)
+
+
+def unpickle_globals(globals_pickle):
+    cell_globals, modules = cPickle.loads(globals_pickle)
+    for name, module_name in modules.items():
+        __import__(module_name)
+        cell_globals[name] = sys.modules[module_name]
+    return cell_globals
+
+
+def pool_interpret(code_text, globals_pickle, binds):
+    """
+    In a CELL_POOL process: run code_text in the pickled globals.
+    Return output, trace, a pickle of the globals in binds that were bound
+    or changed, the names deleted, the names that couldn't be pickled, and
+    the names not in binds that were changed anyway.
+    """
+    cell_globals = unpickle_globals(globals_pickle)
+    before = {}
+    for name, value in cell_globals.items():
+        before[name] = pickle_globals({name: value})
+    output = StringIO.StringIO()
+    trace = ""
+    try:
+        capture_output(output)
+        exec_cell(ast.parse(code_text, "<your input>"), cell_globals)
+    except (Exception, KeyboardInterrupt):
+        trace = traceback.format_exc()
+    finally:
+        capture_output(None)
+
+    changes = {}
+    unpicklable = []
+    mutated = []
+    for name, value in cell_globals.items():
+        if name == "__builtins__":
+            continue
+
+        try:
+            value_pickle = pickle_globals({name: value})
+        except Exception:
+            unpicklable.append(name)
+            continue
+
+        if before.get(name) != value_pickle:
+            if name in binds or "*" in binds:
+                changes[name] = value
+            else:
+                mutated.append(name)
+    deleted = [name for name in before if name not in cell_globals]
+    return output.getvalue(), trace, pickle_globals(changes), \
+        deleted, sorted(unpicklable), sorted(mutated)
 
 
 NOTEBOOK_INPUT_TEXT = """print "Hello, World, I'm Python!" """
 
+def get_edit_index(values):
+    """
+    Return the cell number in an "edit" (query) or "edit_index" (POST)
+    value, or None if there isn't a valid one.
+    """
+    value = values.get("edit", values.get("edit_index"))
+    if isinstance(value, list):
+        value = value[0]
+    try:
+        index = int(value)
+    except (TypeError, ValueError):
+        return None
+
+    if 0 <= index < len(NOTEBOOK_ABOVE):
+        return index
+    else:
+        return None
+
+
 @route("/python/")
 def do_python(environ, start_response):
     global NOTEBOOK_INPUT_TEXT
@@ -552,25 +1811,42 @@ def do_python(environ, start_response):
     raw_dict = {"blank_line": "&nbsp;" * NOTEBOOK_WIDTH}
     chunks.append(fill_template(NOTEBOOK_TOP, {}, raw_dict))
 
+    input_text = NOTEBOOK_INPUT_TEXT
+    edit_index = get_edit_index(urlparse.parse_qs(environ["QUERY_STRING"]))
+    if edit_index != None:
+        # Offer that cell's input for editing.
+        input_text = NOTEBOOK_ABOVE[edit_index][0]
+
     if environ["REQUEST_METHOD"] == "POST":
         # Modify data before rendering.
         values = get_POST_fieldvalues(environ)
         input = unixify_newlines(values["input_text"])
-        response, trace = interpret(input)
-        NOTEBOOK_ABOVE.append( (input, response, trace) )
+        edit_index = get_edit_index(values)
+        if edit_index != None:
+            edit_cell(edit_index, input)
+            trace = NOTEBOOK_ABOVE[edit_index][2]
+        else:
+            response, trace, metrics = interpret(input)
+            NOTEBOOK_ABOVE.append( (input, response, trace, metrics) )
         if trace:
             NOTEBOOK_INPUT_TEXT = input
         else:
             NOTEBOOK_INPUT_TEXT = ""
-
-    for transaction in NOTEBOOK_ABOVE[:-1]:
-        chunks.append(render_notebook_frozen(transaction, NOTEBOOK_WIDTH))
-    chunks.append('<a id="anchor"/>')
-    for transaction in NOTEBOOK_ABOVE[-1:]:
-        chunks.append(render_notebook_frozen(transaction, NOTEBOOK_WIDTH))
-
-    chunks.append(render_notebook_input(NOTEBOOK_INPUT_TEXT,
-                                        NOTEBOOK_WIDTH))
+            edit_index = None
+        input_text = NOTEBOOK_INPUT_TEXT
+
+    n_above = len(NOTEBOOK_ABOVE)
+    for i in range(n_above):
+        if i == n_above - 1:
+            chunks.append('<a id="anchor"/>')
+        chunks.append(render_notebook_frozen(NOTEBOOK_ABOVE[i],
+                                             NOTEBOOK_WIDTH,
+                                             "/python?edit=%d#anchor" % i))
+    if not n_above:
+        chunks.append('<a id="anchor"/>')
+
+    chunks.append(render_notebook_input(input_text, NOTEBOOK_WIDTH,
+                                        edit_index))
                       
     for transaction in NOTEBOOK_BELOW:
         chunks.append(render_notebook_frozen(transaction, NOTEBOOK_WIDTH))
@@ -582,11 +1858,349 @@ def do_python(environ, start_response):
     return [ "".join(chunks) ]
 
 
+@route("/metrics")
+def do_metrics(environ, start_response):
+    """ ROUTE_STATS and a few process gauges, in Prometheus text format. """
+    lines = [
+        "# HELP pyinthephone_requests_total Requests, by route and status.",
+        "# TYPE pyinthephone_requests_total counter",
+        ]
+    with ROUTE_STATS_LOCK:
+        route_stats = sorted((pattern, dict(stats,
+                                            statuses=dict(stats["statuses"]),
+                                            buckets=list(stats["buckets"])))
+                             for pattern, stats in ROUTE_STATS.items())
+    for pattern, stats in route_stats:
+        for status, count in sorted(stats["statuses"].items()):
+            lines.append('pyinthephone_requests_total{route="%s",status="%s"}'
+                         ' %d' % (prometheus_label(pattern), status, count))
+    lines += [
+        "# HELP pyinthephone_response_bytes_total Response bytes, by route.",
+        "# TYPE pyinthephone_response_bytes_total counter",
+        ]
+    for pattern, stats in route_stats:
+        lines.append('pyinthephone_response_bytes_total{route="%s"} %d'
+                     % (prometheus_label(pattern), stats["bytes"]))
+    lines += [
+        "# HELP pyinthephone_request_seconds Request latency, by route.",
+        "# TYPE pyinthephone_request_seconds histogram",
+        ]
+    for pattern, stats in route_stats:
+        label = prometheus_label(pattern)
+        count = 0
+        for bound, n in zip(LATENCY_BUCKETS + ["+Inf"], stats["buckets"]):
+            count += n
+            lines.append('pyinthephone_request_seconds_bucket'
+                         '{route="%s",le="%s"} %d' % (label, bound, count))
+        lines.append('pyinthephone_request_seconds_sum{route="%s"} %r'
+                     % (label, stats["seconds"]))
+        lines.append('pyinthephone_request_seconds_count{route="%s"} %d'
+                     % (label, count))
+
+    for name, help, value in [
+            ("process_resident_memory_bytes", "Resident set size.",
+             resident_bytes()),
+            ("process_open_fds", "Open file descriptors.", open_fds()),
+            ("pyinthephone_notebook_cells", "Cells in the notebook.",
+             len(NOTEBOOK_ABOVE)),
+            ("pyinthephone_running_cells", "Cells being run now.",
+             len(RUNNING_CELLS)),
+            ("pyinthephone_pool_workers", "CELL_POOL processes.",
+             CELL_POOL_SIZE),
+            ]:
+        if value != None:
+            lines += ["# HELP %s %s" % (name, help),
+                      "# TYPE %s gauge" % name,
+                      "%s %d" % (name, value)]
+
+    do_headers(start_response, "200 OK", "text/plain; version=0.0.4")
+    return ["\n".join(lines) + "\n"]
+
+
+def prometheus_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"') \
+                .replace("\n", "\\n")
+
+
+def resident_bytes():
+    """ This process's resident set size, or None if there's no /proc. """
+    try:
+        pages = int(open("/proc/self/statm").read().split()[1])
+    except (IOError, IndexError, ValueError):
+        return None
+
+    return pages * resource.getpagesize()
+
+
+def open_fds():
+    try:
+        return len(os.listdir("/proc/self/fd"))
+    except OSError:
+        return None
+
+
+METRICS_FIELDS = ["cell", "wall_seconds", "cpu_seconds", "peak_rss_kb",
+                  "output_bytes", "ran"]
+
+def notebook_metrics():
+    """ Return a list of metrics dicts, with cell numbers, for the notebook. """
+    rows = []
+    for i, transaction in enumerate(NOTEBOOK_ABOVE):
+        metrics = transaction_metrics(transaction)
+        if metrics:
+            row = dict(metrics)
+            row["cell"] = i
+            rows.append(row)
+    return rows
+
+
+@route("/python/metrics.csv")
+def do_metrics_csv(environ, start_response):
+    if not DO_PYTHON:
+        return do_404(environ, start_response)
+
+    text = StringIO.StringIO()
+    writer = csv.DictWriter(text, METRICS_FIELDS)
+    writer.writeheader()
+    writer.writerows(notebook_metrics())
+    do_headers(start_response, "200 OK", "text/csv")
+    return [text.getvalue()]
+
+
+@route("/python/metrics.json")
+def do_metrics_json(environ, start_response):
+    if not DO_PYTHON:
+        return do_404(environ, start_response)
+
+    do_headers(start_response, "200 OK", "application/json")
+    return [json.dumps(notebook_metrics(), indent=1, sort_keys=True)]
+
+
+DO_DEBUG = False  # See --debug.
+
+# Most seconds and fewest milliseconds between samples /debug/profile allows.
+MAX_PROFILE_SECONDS = 60
+MIN_PROFILE_INTERVAL = 1
+
+@route("/debug/profile")
+def do_profile(environ, start_response):
+    """
+    Sample the stacks of all the other threads every interval milliseconds
+    (default 5) for seconds seconds (default 5), then show the functions
+    with the most samples (the top top, default 20), and all the stacks
+    in the "folded" form that flame graph tools read:
+        outer (file:line);inner (file:line) samples
+    With format=folded, show just the folded stacks.
+    Nothing runs except while a profile is being taken.
+    seconds is kept between 0 and MAX_PROFILE_SECONDS, interval at least
+    MIN_PROFILE_INTERVAL, and top at least 1.
+    """
+    if not DO_DEBUG:
+        return do_404(environ, start_response)
+
+    query = urlparse.parse_qs(environ["QUERY_STRING"])
+    try:
+        seconds = query_number(query, "seconds", 5, float)
+        interval = query_number(query, "interval", 5, float)
+        top = query_number(query, "top", 20, int)
+    except ValueError, e:
+        return do_400(environ, start_response, e)
+
+    seconds = min(max(seconds, 0), MAX_PROFILE_SECONDS)
+    interval = max(interval, MIN_PROFILE_INTERVAL) / 1e3
+    top = max(top, 1)
+    stacks, n_samples = sample_stacks(seconds, interval)
+    folded = ["%s %d\n" % (";".join(stack), count)
+              for stack, count in sorted(stacks.items())]
+    do_headers(start_response, "200 OK", "text/plain")
+    if query.get("format") == ["folded"]:
+        return ["".join(folded)]
+
+    return [profile_table(stacks, n_samples, top), "\n", "".join(folded)]
+
+
+def query_number(query, name, default, convert):
+    """
+    Return query's name parameter made into a number by convert (int or
+    float), or default if there isn't one.  Raise ValueError if it isn't
+    a finite number.
+    """
+    if name not in query:
+        return default
+
+    value = query[name][0]
+    try:
+        number = convert(value)
+    except ValueError:
+        number = None
+    if number == None or number != number or abs(number) == float("inf"):
+        raise ValueError("%s=%s isn't %s." % (name, value, convert == int
+                                              and "a whole number"
+                                              or "a number"))
+    return number
+
+
+def sample_stacks(seconds, interval):
+    """
+    Sample every other thread's stack every interval seconds for seconds.
+    Return a dict of stack (a tuple of frames, outermost first) => times
+    seen, and the number of samples taken.
+    """
+    me = threading.current_thread().ident
+    stacks = {}
+    n_samples = 0
+    stop = time.time() + seconds
+    while time.time() < stop:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == me:
+                continue
+
+            stack = []
+            while frame:
+                code = frame.f_code
+                stack.append("%s (%s:%d)" % (code.co_name,
+                                             os.path.basename(code.co_filename),
+                                             code.co_firstlineno))
+                frame = frame.f_back
+            stack = tuple(reversed(stack))
+            stacks[stack] = stacks.get(stack, 0) + 1
+        n_samples += 1
+        time.sleep(interval)
+    return stacks, n_samples
+
+
+def profile_table(stacks, n_samples, top):
+    """
+    Return a table of the top functions by samples in which they were
+    running ("self"), then by samples in which they were anywhere on the
+    stack ("total").
+    """
+    counts = {}  # function => [-self, -total]
+    for stack, count in stacks.items():
+        counts.setdefault(stack[-1], [0, 0])[0] -= count
+        for function in set(stack):
+            counts.setdefault(function, [0, 0])[1] -= count
+    ranked = sorted((self_total, function)
+                    for function, self_total in counts.items())
+    lines = ["%d samples\n\n" % n_samples,
+             "%8s %8s  %s\n" % ("self", "total", "function")]
+    for (self, total), function in ranked[:top]:
+        lines.append("%8d %8d  %s\n" % (-self, -total, function))
+    return "".join(lines)
+
+
+@route("/debug/memory")
+def do_memory(environ, start_response):
+    """
+    Where the memory is going: the top allocation sites if tracemalloc
+    is tracing (see serve()), the commonest kinds of object the garbage
+    collector knows of, approximate deep sizes of the notebook's globals
+    and history, and the sizes of the caches.
+    ?top=N shows N lines per table (default 20).
+    """
+    if not DO_DEBUG:
+        return do_404(environ, start_response)
+
+    query = urlparse.parse_qs(environ["QUERY_STRING"])
+    top = int(query.get("top", [20])[0])
+    chunks = ["Resident set: %s bytes\n\n" % resident_bytes()]
+
+    if tracemalloc and tracemalloc.is_tracing():
+        chunks.append("Top allocation sites (tracemalloc):\n")
+        snapshot = tracemalloc.take_snapshot()
+        for stat in snapshot.statistics("lineno")[:top]:
+            chunks.append("    %s\n" % stat)
+    else:
+        chunks.append("(No tracemalloc in this Python, so no allocation "
+                      "sites.)\n")
+
+    chunks.append("\nObjects the garbage collector tracks, by type:\n")
+    by_type = {}
+    for obj in gc.get_objects():
+        counts = by_type.setdefault(type(obj).__name__, [0, 0])
+        counts[0] += sys.getsizeof(obj, 0)
+        counts[1] += 1
+    chunks.append("%12s %10s  %s\n" % ("bytes", "count", "type"))
+    for name, (size, count) in sorted(by_type.items(),
+                                      key=lambda item: -item[1][0])[:top]:
+        chunks.append("%12d %10d  %s\n" % (size, count, name))
+
+    chunks.append("\nNotebook globals, deep size (objects shared between "
+                  "globals count under the first):\n")
+    seen = set()
+    sizes = [(deep_size(value, seen), name)
+             for name, value in sorted(NOTEBOOK_GLOBALS.items())
+             if name != "__builtins__"]
+    for size, name in sorted(sizes, reverse=True)[:top]:
+        chunks.append("%12d  %s\n" % (size, name))
+    chunks.append("%12d  (all %d)\n" % (sum(size for size, name in sizes),
+                                         len(sizes)))
+
+    chunks.append("\nNotebook history (%d cells): " % len(NOTEBOOK_ABOVE))
+    if isinstance(NOTEBOOK_ABOVE, list):
+        chunks.append("%d bytes in memory\n" % deep_size(NOTEBOOK_ABOVE,
+                                                          set()))
+    else:
+        chunks.append("%d bytes on disk, not in memory\n"
+                      % os.path.getsize(NOTEBOOK_ABOVE.filename))
+
+    chunks.append("\nCaches:\n")
+    for name, size in [
+            ("MEMO_CACHE (--memoize)", MEMO_STATS["bytes"]),
+            ("BLOBS (without --notebook)",
+             sum(len(data) for data in BLOBS.values())),
+            ("CELL_NAMES", deep_size(CELL_NAMES, set())),
+            ("ROUTE_STATS", deep_size(ROUTE_STATS, set())),
+            ]:
+        chunks.append("%12d  %s\n" % (size, name))
+
+    do_headers(start_response, "200 OK", "text/plain")
+    return chunks
+
+
+# deep_size() neither counts nor follows these, which belong to the
+# program more than to any one value...
+NOT_SIZED = (types.ModuleType, type, types.ClassType)
+# ...and counts but doesn't follow these, which refer to whole namespaces.
+NOT_FOLLOWED = (types.FunctionType, types.MethodType, types.FrameType)
+
+def deep_size(value, seen):
+    """
+    Return the approximate size in bytes of value and everything it
+    refers to, leaving out objects whose ids are in seen, and adding the
+    ids of the objects it counts to seen.
+    """
+    size = 0
+    todo = [value]
+    while todo:
+        obj = todo.pop()
+        if id(obj) in seen or isinstance(obj, NOT_SIZED):
+            continue
+
+        seen.add(id(obj))
+        size += sys.getsizeof(obj, 0)
+        if not isinstance(obj, NOT_FOLLOWED):
+            todo += gc.get_referents(obj)
+    return size
+
+
+class Quiet_request_handler(wsgiref.simple_server.WSGIRequestHandler):
+    """ A request handler that leaves logging to ACCESS_LOG. """
+    def log_request(self, code="-", size="-"):
+        pass
+
+
+class Threading_WSGI_server(SocketServer.ThreadingMixIn,
+                            wsgiref.simple_server.WSGIServer):
+    daemon_threads = True
+
+
 def serve(*pargs, **kargs):
-    global DO_PYTHON
+    global DO_PYTHON, CELL_POOL, MEMO_MAX_BYTES, NOTEBOOK_ABOVE, BLOB_DIR
+    global ACCESS_LOG, DO_DEBUG, CELL_POOL_SIZE
 
     args, files = optparser.parse_args(make_argv(*pargs, **kargs))
-    allow_files(files)
+    allow_files(files, args.scan_seconds)
     if args.public:
         host = socket.gethostbyname(socket.getfqdn())
         if host == "127.0.0.1":
@@ -595,12 +2209,49 @@ def serve(*pargs, **kargs):
         host = "127.0.0.1"
     port = args.port
     DO_PYTHON = args.python
-    
-    httpd = wsgiref.simple_server.make_server(host, port, app)
+    DO_DEBUG = args.debug
+    if DO_DEBUG and tracemalloc:
+        tracemalloc.start()
+    MEMO_MAX_BYTES = int(args.memoize * 2**20)
+    install_output_routers()
+    if DO_PYTHON and args.parallel:
+        # Fork the pool before any request threads exist.
+        CELL_POOL = multiprocessing.Pool(args.parallel)
+        CELL_POOL_SIZE = args.parallel
+    if DO_PYTHON and args.notebook:
+        NOTEBOOK_ABOVE = notebook_log.Notebook_log(args.notebook)
+        BLOB_DIR = args.notebook + ".blobs"
+
+    if args.threads:
+        server_class = Threading_WSGI_server
+    else:
+        server_class = wsgiref.simple_server.WSGIServer
+    handler_class = wsgiref.simple_server.WSGIRequestHandler
+    if args.access_log:
+        ACCESS_LOG = access_log.Access_log(args.access_log,
+                                           int(args.access_log_mbytes * 2**20))
+        handler_class = Quiet_request_handler
+    httpd = wsgiref.simple_server.make_server(host, port, app, server_class,
+                                              handler_class)
+    if args.startup_times:
+        print_startup_times()
     print "Serving on host:port %s:%d" % (host, port)
     # Serve until process is killed
     httpd.serve_forever()
 
 
+def print_startup_times():
+    """
+    Print IMPORT_TIMES (modules loaded by others indented under them,
+    leaving out those under a millisecond), then the time since this file
+    started loading.
+    """
+    print "Startup times (ms):"
+    for depth, name, seconds in IMPORT_TIMES:
+        if depth == 0 or seconds >= 0.001:
+            print "%8.1f  %s%s" % (seconds * 1e3, "    " * depth, name)
+    print "%8.1f  listening" % ((time.time() - START_TIME) * 1e3)
+
+
 if __name__ == "__main__":
     serve(*argv[1:])
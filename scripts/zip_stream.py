@@ -0,0 +1,187 @@
+#!/usr/bin/env python
+""" zip_stream.py
+    Copyright (c) 2013 Steve Witham All rights reserved.
+    PyInThePhone is available under a BSD license, whose full text is at:
+        https://github.com/switham/pyinthephone/blob/master/LICENSE
+
+A ZIP archive of some files, made while it's being sent, for
+pyinthephone.py's /bundle.zip.
+
+zipfile.ZipFile wants to seek back and fill in each file's CRC and sizes
+after writing its data, so it needs the whole archive in a real file (or
+in memory).  zip_stream() instead writes each file as
+    local header, with the CRC and sizes left as zero and flag bit 3 set,
+    the data, stored or deflated, a block at a time,
+    a data descriptor, giving the CRC and sizes after all,
+and then the central directory, which unzippers read first anyway.  Only
+one block of one file is in memory at a time, plus a central directory
+entry per file.
+
+Offsets past 4 GB, and more than 65535 files, get ZIP64 records.  Files
+of 4 GB or more are left out.
+
+Names in the archive should come from archive_name(), so that unzipping
+it can't write outside the directory it's unzipped in.
+"""
+
+import os
+import time
+import zlib
+import struct
+
+
+# Extensions of files that are already compressed, and so are stored as
+# they are instead of deflated.
+STORED_EXTENSIONS = set("""
+    .zip .jar .apk .gz .tgz .bz2 .xz .7z .rar
+    .jpg .jpeg .png .gif .webp
+    .mp3 .m4a .ogg .oga .opus .aac .flac
+    .mp4 .m4v .mkv .webm .avi .mov .3gp
+    """.split())
+
+BLOCK_SIZE = 65536
+DEFLATE_LEVEL = 6
+
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+DATA_DESCRIPTOR = struct.Struct("<IIII")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_OFFSET = struct.Struct("<HHQ")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+
+VERSION = 20        # Deflate and data descriptors need version 2.0.
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+FLAG_DESCRIPTOR = 0x08
+STORED = 0
+DEFLATED = 8
+MAX_32 = 0xffffffff
+MAX_16 = 0xffff
+
+
+def should_deflate(name):
+    """ Deflate name unless its extension is in STORED_EXTENSIONS. """
+    return os.path.splitext(name)[1].lower() not in STORED_EXTENSIONS
+
+
+def archive_name(path):
+    """
+    Return path as a name for a ZIP archive: relative, with "/" between
+    its parts, and with no ".." parts or drive.  (It may be "".)
+    """
+    path = os.path.splitdrive(os.path.normpath(path))[1]
+    parts = path.replace(os.sep, "/").split("/")
+    return "/".join(part for part in parts if part not in ("", ".", ".."))
+
+
+def zip_stream(files, deflate=should_deflate, block_size=BLOCK_SIZE):
+    """
+    Generate a ZIP archive, in pieces, of files, a sequence of (name in
+    the archive, path).  Files that can't be opened are left out.
+    deflate(name) says whether to compress a file or just store it.
+    """
+    offset = 0
+    central = []
+    for name, path in files:
+        try:
+            input = open(path, "rb")
+        except IOError:
+            continue
+
+        with input:
+            stat = os.fstat(input.fileno())
+            if stat.st_size >= MAX_32:
+                continue
+
+            method = deflate(name) and DEFLATED or STORED
+            dos_time, dos_date = dos_date_time(stat.st_mtime)
+            header = LOCAL_HEADER.pack(0x04034b50, VERSION, FLAG_DESCRIPTOR,
+                                       method, dos_time, dos_date, 0, 0, 0,
+                                       len(name), 0) + name
+            yield header
+
+            crc = 0
+            size = compressed_size = 0
+            compressor = method == DEFLATED \
+                and zlib.compressobj(DEFLATE_LEVEL, zlib.DEFLATED, -15)
+            while True:
+                block = input.read(block_size)
+                if not block:
+                    break
+
+                crc = zlib.crc32(block, crc)
+                size += len(block)
+                if compressor:
+                    block = compressor.compress(block)
+                compressed_size += len(block)
+                if block:
+                    yield block
+            if compressor:
+                block = compressor.flush()
+                compressed_size += len(block)
+                yield block
+        crc &= MAX_32
+        yield DATA_DESCRIPTOR.pack(0x08074b50, crc, compressed_size, size)
+
+        central.append(central_header(name, method, dos_time, dos_date, crc,
+                                      compressed_size, size,
+                                      stat.st_mode, offset))
+        offset += len(header) + compressed_size + DATA_DESCRIPTOR.size
+
+    central_size = 0
+    for header in central:
+        yield header
+        central_size += len(header)
+    for record in end_records(len(central), central_size, offset):
+        yield record
+
+
+def central_header(name, method, dos_time, dos_date, crc, compressed_size,
+                   size, mode, offset):
+    """
+    Return a file's central directory entry, with a ZIP64 extra field
+    holding its offset if that's too big for the entry itself.
+    """
+    extra = ""
+    version = VERSION
+    if offset >= MAX_32:
+        extra = ZIP64_OFFSET.pack(0x0001, ZIP64_OFFSET.size - 4, offset)
+        offset = MAX_32
+        version = VERSION_ZIP64
+    return CENTRAL_HEADER.pack(0x02014b50, MADE_BY_UNIX | version, version,
+                               FLAG_DESCRIPTOR, method, dos_time, dos_date,
+                               crc, compressed_size, size, len(name),
+                               len(extra), 0, 0, 0, (mode & 0xffff) << 16,
+                               offset) + name + extra
+
+
+def end_records(n_files, central_size, central_offset):
+    """
+    Return the end of central directory record, preceded by the ZIP64
+    ones if n_files or the central directory's place need them.
+    """
+    records = []
+    if n_files >= MAX_16 or central_size >= MAX_32 \
+            or central_offset >= MAX_32:
+        zip64_end_offset = central_offset + central_size
+        records.append(ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12,
+                                      MADE_BY_UNIX | VERSION_ZIP64,
+                                      VERSION_ZIP64, 0, 0, n_files, n_files,
+                                      central_size, central_offset))
+        records.append(ZIP64_LOCATOR.pack(0x07064b50, 0, zip64_end_offset, 1))
+        n_files = min(n_files, MAX_16)
+        central_size = min(central_size, MAX_32)
+        central_offset = min(central_offset, MAX_32)
+    records.append(END.pack(0x06054b50, 0, 0, n_files, n_files,
+                            central_size, central_offset, 0))
+    return records
+
+
+def dos_date_time(mtime):
+    """ Return the MS-DOS (time, date) for local time mtime. """
+    year, month, day, hour, minute, second = time.localtime(mtime)[:6]
+    if year < 1980:
+        year, month, day, hour, minute, second = 1980, 1, 1, 0, 0, 0
+    return ((hour << 11) | (minute << 5) | (second // 2),
+            ((year - 1980) << 9) | (month << 5) | day)